@@ -0,0 +1,612 @@
+#!/QOpensys/pkgs/bin/python3
+
+# Simulates the ssh command line interface of an HMC, so vnic-check.py and vnic-move.py can be
+#  tested and benchmarked without a real HMC.
+# Find the current version on Github at https://github.com/IBM/blog-vios4i
+# See https://blog.vios4i.com for setup and usage instructions
+# Eclipse Public License v2.0
+# license: epl-2.0
+
+import io
+import os
+import sys
+import json
+import time
+import shlex
+import random
+import zlib
+import contextlib
+import uuid
+import threading
+import http.server
+import socketserver
+from xml.sax.saxutils import escape, quoteattr
+
+description = """Simulates the ssh command line interface of an HMC
+
+This is run in place of ssh, with the same arguments: [ssh options] [user@]hmc [command].  The
+ssh options are ignored, and a call without a command (like the ControlMaster start and stop calls)
+does nothing.  The command is run against a made up fleet of managed systems that is always the same
+for the same options, so runs can be compared.  The lssyscfg -r sys, lshwres -r virtualio --rsubtype
+vnic, lshwres -r sriov --rsubtype physport and chhwres commands used by vnic-check.py and
+vnic-move.py are supported, joined with ; and echo like the scripts send them, along with lshmc -n and
+the for loop over the managed systems in the offline bundle command of vnic-check.py --offline.
+
+The simulator options come before the ssh arguments and must use the --name=value form:
+
+  vnic-check.py --hmc sim1 --ssh "python3 hmc-sim.py --systems=20 --lpars=100 --latency=0.5"
+
+Fleet options:
+  --systems=N        managed systems on each HMC (default 4)
+  --lpars=N          client LPARs with vNICs on each system (default 20)
+  --vnics=N          vNICs on each client LPAR (default 1)
+  --backing=N        backing devices on each vNIC (default 2)
+  --vios=N           VIOS on each system, the backing devices are spread over them (default 2)
+  --adapters=N       SRIOV adapters on each system, with 4 physical ports each (default 2)
+  --seed=N           seed for the made up failures (default 1)
+  --churn=S          pick new failures every S seconds instead of always the same ones (default 0, never)
+
+Failure options (rates are from 0 to 1):
+  --fail-rate=P      backing devices that are not operational (default 0.05)
+  --misorder-rate=P  vNICs that are not active on their lowest priority backing device (default 0.02)
+  --off-rate=P       managed systems that are not in the Operating state (default 0)
+
+Error and latency options:
+  --latency=S        seconds added to every ssh call, like a login (default 0)
+  --cmd-latency=S    seconds added to every HMC command (default 0)
+  --row-latency=S    seconds added for every output row (default 0)
+  --jitter=F         each delay is randomly changed by up to this fraction (default 0)
+  --down=HMC,...     HMC names that can not be reached (ssh exit code 255)
+  --ssh-fail-rate=P  ssh calls that fail with exit code 255 (default 0)
+  --error-rate=P     query commands that fail with an HMC error message (default 0)
+  --hang-rate=P      commands that hang for --hang seconds before they answer (default 0)
+  --hang=S           seconds a hung command takes (default 600)
+  --malformed-rate=P output lines that have an extra field and are dropped by the parser (default 0)
+
+State options:
+  --state=FILE       keeps the chhwres changes in this JSON file, so a later lshwres shows them
+  --lag=S            seconds before a chhwres change shows up in lshwres (default 2)
+
+REST API options:
+  --rest=PORT        serve a mock of the HMC REST API on this port instead of acting as ssh, for
+                     --transport rest with --rest-url 'http://localhost:PORT/{hmc}'
+  --password=TEXT    the only password the REST logon accepts (default any password)
+  --verbose=1        print each REST request and each new connection
+
+The REST mock serves plain http, with the HMC name as the first part of the path (or taken from
+the Host header), so one mock can stand in for many HMCs.  It has the same fleet as the ssh
+commands, and the same latency (--latency for each logon, --cmd-latency for each request,
+--row-latency for each entry) and error knobs (HTTP 503 for --down, HTTP 500 for --error-rate).
+"""
+
+options = {'systems': 4, 'lpars': 20, 'vnics': 1, 'backing': 2, 'vios': 2, 'adapters': 2, 'seed': 1, 'churn': 0.0,
+           'fail-rate': 0.05, 'misorder-rate': 0.02, 'off-rate': 0.0,
+           'latency': 0.0, 'cmd-latency': 0.0, 'row-latency': 0.0, 'jitter': 0.0, 'down': '',
+           'ssh-fail-rate': 0.0, 'error-rate': 0.0, 'hang-rate': 0.0, 'hang': 600.0, 'malformed-rate': 0.0,
+           'state': None, 'lag': 2.0, 'rest': 0, 'password': '', 'verbose': 0}
+
+# ssh options that take a value, all of the others are flags
+sshvalueopts = ('-o','-O','-S','-p','-l','-i','-F','-E','-J','-L','-R','-D','-W','-b','-c','-m','-e')
+
+
+def parse_args(argv):
+  """splits the command line into the simulator options, the HMC name and the command
+
+  Returns a tuple of (HMC name, command), the command is None if there is none
+  """
+
+  i = 0
+  while i < len(argv) and argv[i].startswith('--'):
+    name, sep, value = argv[i][2:].partition('=')
+    if (name == 'help'):
+      print(description)
+      exit(0)
+    if (name not in options or sep == ''):
+      print(f"hmc-sim.py: unknown option or missing =value: {argv[i]}", file=sys.stderr)
+      exit(2)
+    if (isinstance(options[name], int)):
+      options[name] = int(value)
+    elif (isinstance(options[name], float)):
+      options[name] = float(value)
+    else:
+      options[name] = value
+    i += 1
+
+  hmc = None
+  while i < len(argv):
+    if (argv[i] in sshvalueopts):
+      i += 2
+      continue
+    if (argv[i].startswith('-')):
+      i += 1
+      continue
+    if (hmc is None):
+      hmc = argv[i].split('@')[-1]
+      i += 1
+      continue
+    break
+
+  # ssh joins the rest of the arguments with spaces into the remote command
+  command = ' '.join(argv[i:]) if i < len(argv) else None
+  return (hmc, command)
+
+
+def chance(rate, *key):
+  """returns True for the given fraction of keys, always the same answer for the same key and seed"""
+
+  if (rate <= 0):
+    return False
+  epoch = int(time.time() // options['churn']) if options['churn'] > 0 else 0
+  seed = zlib.crc32(repr((options['seed'], epoch) + key).encode())
+  return random.Random(seed).random() < rate
+
+
+def pause(seconds):
+  """sleeps for the given number of seconds, changed by up to the --jitter fraction"""
+
+  if (seconds > 0):
+    time.sleep(seconds * (1 + options['jitter'] * (2 * random.random() - 1)))
+
+
+def system_names(hmc):
+  """returns the names of the managed systems on an HMC"""
+
+  return [f"{hmc}-sys{n+1:03d}" for n in range(options['systems'])]
+
+
+def system_record(hmc, sysname, n):
+  """returns the lssyscfg -r sys fields of a managed system"""
+
+  serial = f"78{zlib.crc32(sysname.encode()) % 100000:05d}"
+  state = "Power Off" if chance(options['off-rate'], 'off', sysname) else "Operating"
+  return {'name': sysname, 'type_model': '9009-42A', 'serial_num': serial, 'state': state}
+
+
+def port_records(sysname):
+  """returns the lshwres -r sriov --rsubtype physport --level eth fields of every port on a system"""
+
+  serial = f"78{zlib.crc32(sysname.encode()) % 100000:05d}"
+  records = []
+  for adapter in range(options['adapters']):
+    for port in range(4):
+      records.append({'adapter_id': str(adapter+1), 'phys_port_id': str(port), 'phys_port_label': '', 'phys_port_sub_label': '',
+                      'phys_port_loc': f"U78D2.001.{serial}-P1-C{adapter+2}-T{port+1}", 'state': '1',
+                      'config_speed': 'auto', 'curr_speed': '10000'})
+  return records
+
+
+def vnic_model(sysname, state):
+  """returns the vNICs of a system, for vnic_records and the REST API
+
+  Parameter 1 - the managed system name
+  Parameter 2 - the state from load_state with the chhwres changes
+
+  Returns a list of dictionaries with the lpar_name, lpar_id, slot, autofailover, active logical
+   port and the list of backing devices of each vNIC
+  """
+
+  now = time.time()
+  vioses = [(f"{sysname}-vios{v+1}", str(v+1)) for v in range(options['vios'])]
+  vnics = []
+  logport = 0
+  for lpar in range(options['lpars']):
+    lparid = str(options['vios'] + lpar + 1)
+    for vnic in range(options['vnics']):
+      slot = str(vnic + 3)
+      devices = []
+      for b in range(options['backing']):
+        viosname, viosid = vioses[b % len(vioses)]
+        adapter = b % options['adapters'] + 1
+        logport += 1
+        devices.append({'vios': viosname, 'viosid': viosid, 'adapter': str(adapter), 'port': str((lpar + b) % 4),
+                        'logport': f"27{adapter:02x}{logport:04x}", 'priority': str((b+1)*10),
+                        'operational': not chance(options['fail-rate'], 'fail', sysname, lparid, slot, b)})
+
+      # the lowest priority device is active, unless this vNIC is picked to be out of order
+      active = devices[0]['logport']
+      if (len(devices) > 1 and chance(options['misorder-rate'], 'misorder', sysname, lparid, slot)):
+        active = devices[1]['logport']
+      autofailover = '1'
+      change = state.get(f"{sysname}/{lparid}/{slot}/logport")
+      if (change is not None and change[1] <= now):
+        active = change[0]
+      change = state.get(f"{sysname}/{lparid}/{slot}/auto_priority_failover")
+      if (change is not None and change[1] <= now):
+        autofailover = change[0]
+
+      vnics.append({'lpar_name': f"lpar{lparid}", 'lpar_id': lparid, 'slot': slot, 'autofailover': autofailover,
+                    'active': active, 'devices': devices})
+  return vnics
+
+
+def vnic_records(sysname, state):
+  """returns the lshwres -r virtualio --rsubtype vnic fields of every vNIC on a system
+
+  Parameter 1 - the managed system name
+  Parameter 2 - the state from load_state with the chhwres changes
+  """
+
+  records = []
+  for vnic in vnic_model(sysname, state):
+    devices = vnic['devices']
+    backing = ','.join(f"sriov/{d['vios']}/{d['viosid']}/{d['adapter']}/{d['port']}/{d['logport']}/2.0/2.0/{d['priority']}/100.0/100.0"
+                       for d in devices)
+    states = ','.join(f"sriov/{d['logport']}/{int(d['logport'] == vnic['active'])}/{'Operational' if d['operational'] else 'NotOperational'}"
+                      for d in devices)
+    records.append({'lpar_name': vnic['lpar_name'], 'lpar_id': vnic['lpar_id'], 'slot_num': vnic['slot'],
+                    'auto_priority_failover': vnic['autofailover'], 'backing_devices': backing, 'backing_device_states': states,
+                    'port_vlan_id': '1', 'mac_addr': '', 'allowed_os_mac_addrs': 'all', 'desired_mode': 'ded', 'curr_mode': 'ded'})
+  return records
+
+
+def load_state():
+  """returns the chhwres changes saved in the --state file, an empty dictionary if there is none"""
+
+  if (options['state'] is None):
+    return dict()
+  try:
+    with open(options['state']) as f:
+      return json.load(f)
+  except (OSError, ValueError):
+    return dict()
+
+
+def save_change(key, value):
+  """saves one chhwres change in the --state file, to show up in lshwres after --lag seconds"""
+
+  if (options['state'] is None):
+    return
+  # the file is locked so commands run at the same time do not lose each other's changes
+  import fcntl
+  with open(options['state'] + ".lock", "w") as lock:
+    fcntl.flock(lock, fcntl.LOCK_EX)
+    state = load_state()
+    state[key] = [value, time.time() + options['lag']]
+    tmpname = options['state'] + ".tmp"
+    with open(tmpname, "w") as f:
+      json.dump(state, f)
+    os.replace(tmpname, options['state'])
+
+
+def print_records(argv, records):
+  """prints records the way the HMC does for -F (with the fields joined by the delimiter used in -F) and --header"""
+
+  if (len(records) == 0):
+    print("No results were found.")
+    return
+
+  fieldlist = argv[argv.index('-F')+1] if '-F' in argv else None
+  if fieldlist is None:
+    # without -F the HMC prints name=value pairs
+    for record in records:
+      print(','.join(f"{name}={value}" for name, value in record.items()))
+      pause(options['row-latency'])
+    return
+
+  delim = next((c for c in fieldlist if not (c.isalnum() or c == '_')), ',')
+  fields = fieldlist.split(delim)
+
+  def value(record, field):
+    v = record.get(field, 'null')
+    if (delim in v):
+      v = '"' + v.replace('"', '""') + '"'
+    return v
+
+  out = sys.stdout
+  if ('--header' in argv):
+    out.write(delim.join(fields) + "\n")
+  for n, record in enumerate(records):
+    line = delim.join(value(record, field) for field in fields)
+    if (chance(options['malformed-rate'], 'malformed', line, n)):
+      line += delim
+    out.write(line + "\n")
+    pause(options['row-latency'])
+
+
+def run_command(hmc, argv, rc):
+  """runs one HMC command and returns its exit code
+
+  Parameter 1 - the HMC name
+  Parameter 2 - the command split into words
+  Parameter 3 - the exit code of the command before it, for echo $?
+  """
+
+  if (argv[0] == 'echo'):
+    print(' '.join(word.replace('$?', str(rc)) for word in argv[1:]))
+    return 0
+
+  def opt(name):
+    return argv[argv.index(name)+1] if name in argv else None
+
+  pause(options['cmd-latency'])
+  if (random.random() < options['hang-rate']):
+    time.sleep(options['hang'])
+
+  sysname = opt('-m')
+  if (sysname is not None and sysname not in system_names(hmc)):
+    print(f"HSCL8012 The managed system {sysname} was not found.", file=sys.stderr)
+    return 1
+
+  if (argv[0] in ('lssyscfg', 'lshwres') and random.random() < options['error-rate']):
+    print("HSCL3205 The managed system is busy, please try again later.", file=sys.stderr)
+    return 1
+
+  if (argv[0] == 'lssyscfg' and opt('-r') == 'sys'):
+    print_records(argv, [system_record(hmc, name, n) for n, name in enumerate(system_names(hmc))])
+  elif (argv[0] == 'lshwres' and opt('-r') == 'virtualio' and opt('--rsubtype') == 'vnic'):
+    print_records(argv, vnic_records(sysname, load_state()))
+  elif (argv[0] == 'lshwres' and opt('-r') == 'sriov' and opt('--rsubtype') == 'physport'):
+    print_records(argv, port_records(sysname) if opt('--level') == 'eth' else [])
+  elif (argv[0] == 'lshmc' and '-n' in argv):
+    print(hmc)
+  elif (argv[0] == 'chhwres' and opt('--rsubtype') == 'vnicbkdev' and opt('-o') == 'act'):
+    save_change(f"{sysname}/{opt('--id')}/{opt('-s')}/logport", opt('--logport'))
+  elif (argv[0] == 'chhwres' and opt('--rsubtype') == 'vnic' and opt('-o') == 's'):
+    name, sep, value = (opt('-a') or '').partition('=')
+    save_change(f"{sysname}/{opt('--id')}/{opt('-s')}/{name}", value)
+  elif (argv[0] in ('lssyscfg', 'lshwres', 'chhwres')):
+    print(f"HSCL350B The command {' '.join(argv[:4])} is not supported by hmc-sim.py", file=sys.stderr)
+    return 1
+  else:
+    print(f"rbash: {argv[0]}: command not found", file=sys.stderr)
+    return 127
+  return 0
+
+
+def run_shell(hmc, command, rc=0):
+  """runs a command line of HMC commands joined with ; and returns the exit code of the last one
+
+  A for loop over a list of words or over the output of a command, like
+  for m in $(lssyscfg -r sys -F name); do lshwres -m "$m" ...; done, is run too.
+  """
+
+  lexer = shlex.shlex(command, posix=True, punctuation_chars=';')
+  lexer.whitespace_split = True
+  return run_words(hmc, list(lexer), rc)
+
+
+def run_words(hmc, words, rc):
+  """runs a command line split into words by run_shell and returns the exit code of the last command"""
+
+  argv = []
+  i = 0
+  while i < len(words):
+    word = words[i]
+    if (word == 'for' and len(argv) == 0):
+      # for NAME in WORDS; do COMMANDS; done
+      name = words[i+1]
+      listend = words.index(';', i)
+      items = words[i+3:listend]
+      if (len(items) > 0 and items[0].startswith('$(')):
+        items = command_output(hmc, ' '.join(items)[2:-1]).split()
+      depth = 0
+      for done in range(listend+2, len(words)):
+        if (words[done] == 'for'):
+          depth += 1
+        elif (words[done] == 'done'):
+          if (depth == 0):
+            break
+          depth -= 1
+      body = words[listend+2:done]
+      for item in items:
+        rc = run_words(hmc, [w.replace('$'+name, item) for w in body], rc)
+      i = done + 1
+      continue
+    if (word == ';'):
+      if (len(argv) > 0):
+        rc = run_command(hmc, argv, rc)
+        sys.stdout.flush()
+      argv = []
+    else:
+      argv.append(word)
+    i += 1
+  if (len(argv) > 0):
+    rc = run_command(hmc, argv, rc)
+    sys.stdout.flush()
+  return rc
+
+
+def command_output(hmc, command):
+  """runs an HMC command line for a $(command) and returns its output"""
+
+  out = io.StringIO()
+  with contextlib.redirect_stdout(out):
+    run_shell(hmc, command)
+  return out.getvalue()
+
+
+uomns = "http://www.ibm.com/xmlns/systems/power/firmware/uom/mc/2012_10/"
+restsessions = set() # session tokens handed out by the REST logon
+restlock = threading.Lock()
+
+
+def object_id(*names):
+  """returns the REST API UUID of a made up object, always the same for the same names"""
+
+  return str(uuid.uuid5(uuid.NAMESPACE_URL, '/'.join(names)))
+
+
+def rest_xml(tag, fields):
+  """returns the XML of a REST API object from a list of (element name, text or nested XML) pairs
+
+  A pair with None for the name adds its XML as it is.
+  """
+
+  body = ''.join(value if name is None else f"<{name}>{value}</{name}>" for name, value in fields)
+  return f'<{tag} xmlns="{uomns}" schemaVersion="V1_0">{body}</{tag}>'
+
+
+def rest_feed(entries):
+  """returns an Atom feed of (UUID, object type, object XML) entries"""
+
+  body = ''.join(f'<entry><id>{entryid}</id><content type="application/vnd.ibm.powervm.uom+xml; type={kind}">{xml}</content></entry>'
+                 for entryid, kind, xml in entries)
+  return f'<feed xmlns="http://www.w3.org/2005/Atom">{body}</feed>'
+
+
+def rest_system(hmc, sysname, n):
+  """returns the ManagedSystem REST API object of a system, with its SRIOV adapters and physical ports"""
+
+  record = system_record(hmc, sysname, n)
+  machinetype, sep, model = record['type_model'].partition('-')
+  adapters = {}
+  for port in port_records(sysname):
+    adapters.setdefault(port['adapter_id'], []).append(rest_xml('SRIOVEthernetPhysicalPort', [
+      ('Label', escape(port['phys_port_label'])), ('LocationCode', escape(port['phys_port_loc'])),
+      ('PhysicalPortID', port['phys_port_id']), ('SubLabel', escape(port['phys_port_sub_label']))]))
+  sriov = ''.join(f"<IOAdapterChoice>{rest_xml('SRIOVAdapter', [('AdapterID', adapterid), ('EthernetPhysicalPorts', ''.join(ports))])}</IOAdapterChoice>"
+                  for adapterid, ports in adapters.items())
+  return rest_xml('ManagedSystem', [
+    ('AssociatedSystemIOConfiguration', f"<SRIOVAdapters>{sriov}</SRIOVAdapters>"),
+    ('MachineTypeModelAndSerialNumber', f"<MachineType>{machinetype}</MachineType><Model>{model}</Model><SerialNumber>{record['serial_num']}</SerialNumber>"),
+    ('State', record['state'].lower()), ('SystemName', escape(sysname))])
+
+
+def rest_answer(hmc, path):
+  """returns a tuple of (HTTP status, XML) for a GET of a REST API path on the mock HMC"""
+
+  systems = {object_id(hmc, name): (n, name) for n, name in enumerate(system_names(hmc))}
+  parts = path.strip('/').split('/')
+
+  if (parts == ['rest', 'api', 'uom', 'ManagedSystem']):
+    return (200, rest_feed([(sysid, 'ManagedSystem', rest_system(hmc, name, n)) for sysid, (n, name) in systems.items()]))
+
+  if (parts[:4] == ['rest', 'api', 'uom', 'ManagedSystem'] and parts[4] in systems):
+    n, sysname = systems[parts[4]]
+    if (len(parts) == 5):
+      return (200, rest_feed([(parts[4], 'ManagedSystem', rest_system(hmc, sysname, n))]))
+    if (parts[5:] == ['VirtualIOServer']):
+      return (200, rest_feed([(object_id(hmc, sysname, f"{sysname}-vios{v+1}"), 'VirtualIOServer',
+                               rest_xml('VirtualIOServer', [('PartitionID', str(v+1)), ('PartitionName', f"{sysname}-vios{v+1}")]))
+                              for v in range(options['vios'])]))
+    if (parts[5:] == ['LogicalPartition']):
+      lpars = []
+      for vnic in vnic_model(sysname, dict()):
+        if vnic['slot'] == '3':
+          lpars.append((object_id(hmc, sysname, vnic['lpar_id']), 'LogicalPartition',
+                        rest_xml('LogicalPartition', [('PartitionID', vnic['lpar_id']), ('PartitionName', vnic['lpar_name'])])))
+      return (200, rest_feed(lpars))
+
+  if (parts[:4] == ['rest', 'api', 'uom', 'LogicalPartition'] and parts[5:] == ['VirtualNICDedicated']):
+    for sysid, (n, sysname) in systems.items():
+      vnics = [vnic for vnic in vnic_model(sysname, load_state()) if object_id(hmc, sysname, vnic['lpar_id']) == parts[4]]
+      if (len(vnics) == 0):
+        continue
+      entries = []
+      for vnic in vnics:
+        devices = ''.join(rest_xml('VirtualNICSRIOVBackingDevice', [
+          (None, '<AssociatedVirtualIOServer href=' + quoteattr(f"/rest/api/uom/ManagedSystem/{sysid}/VirtualIOServer/{object_id(hmc, sysname, d['vios'])}") + ' rel="related"/>'),
+          ('IsActive', 'true' if d['logport'] == vnic['active'] else 'false'),
+          ('Status', 'Operational' if d['operational'] else 'NotOperational'), ('FailOverPriority', d['priority']),
+          ('SRIOVAdapterID', d['adapter']), ('PhysicalPortID', d['port']), ('LogicalPortID', d['logport']),
+          ('CurrentCapacityPercentage', '2.0'), ('DesiredCapacityPercentage', '2.0'),
+          ('CurrentMaxCapacityPercentage', '100.0'), ('DesiredMaxCapacityPercentage', '100.0')])
+          for d in vnic['devices'])
+        entries.append((object_id(hmc, sysname, vnic['lpar_id'], vnic['slot']), 'VirtualNICDedicated', rest_xml('VirtualNICDedicated', [
+          ('AssociatedBackingDevices', devices), ('AutoPriorityFailover', 'true' if vnic['autofailover'] == '1' else 'false'),
+          ('VirtualSlotNumber', vnic['slot'])])))
+        pause(options['row-latency'])
+      return (200, rest_feed(entries))
+    # an LPAR without vNICs has an empty feed
+    return (204, '')
+
+  return (404, '')
+
+
+class RestHandler(http.server.BaseHTTPRequestHandler):
+  """answers the REST API requests of vnic-check.py and vnic-move.py with --transport rest"""
+
+  protocol_version = 'HTTP/1.1' # keep-alive, like the HMC
+
+  def setup(self):
+    http.server.BaseHTTPRequestHandler.setup(self)
+    if (options['verbose']):
+      print(f"new connection from {self.client_address[0]}:{self.client_address[1]}", file=sys.stderr, flush=True)
+
+  def log_message(self, format, *args):
+    if (options['verbose']):
+      http.server.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+  def reply(self, status, body='', contenttype='application/atom+xml'):
+    data = body.encode()
+    self.send_response(status)
+    self.send_header('Content-Type', contenttype)
+    self.send_header('Content-Length', str(len(data)))
+    self.end_headers()
+    self.wfile.write(data)
+
+  def hmc_path(self):
+    """returns a tuple of (HMC name, REST path) from the first part of the path or the Host header"""
+
+    parts = self.path.split('?')[0].split('/', 2)
+    if (len(parts) == 3 and parts[1] != 'rest'):
+      return (parts[1], '/' + parts[2])
+    return (self.headers.get('Host', 'hmc').split(':')[0], self.path.split('?')[0])
+
+  def do_PUT(self):
+    hmc, path = self.hmc_path()
+    body = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode()
+    if (path != '/rest/api/web/Logon'):
+      return self.reply(404)
+    pause(options['latency'])
+    if (options['password'] != '' and f"<Password>{escape(options['password'])}</Password>" not in body):
+      return self.reply(401)
+    token = uuid.uuid4().hex
+    with restlock:
+      restsessions.add(token)
+    self.reply(200, '<LogonResponse xmlns="http://www.ibm.com/xmlns/systems/power/firmware/web/mc/2012_10/" schemaVersion="V1_0">'
+                    f'<X-API-Session>{token}</X-API-Session></LogonResponse>', 'application/vnd.ibm.powervm.web+xml; type=LogonResponse')
+
+  def do_DELETE(self):
+    with restlock:
+      restsessions.discard(self.headers.get('X-API-Session'))
+    self.reply(204)
+
+  def do_GET(self):
+    hmc, path = self.hmc_path()
+    if (self.headers.get('X-API-Session') not in restsessions):
+      return self.reply(401)
+    pause(options['cmd-latency'])
+    if (random.random() < options['hang-rate']):
+      time.sleep(options['hang'])
+    if (hmc in options['down'].split(',')):
+      return self.reply(503)
+    if (random.random() < options['error-rate']):
+      return self.reply(500)
+    status, body = rest_answer(hmc, path)
+    self.reply(status, body)
+
+
+class RestServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+  daemon_threads = True
+
+
+#
+## Start of Mainline
+#
+
+if __name__ == '__main__':
+  hmc, command = parse_args(sys.argv[1:])
+  if (options['rest'] > 0):
+    print(f"hmc-sim.py REST API mock on http://localhost:{options['rest']}/<hmc>", flush=True)
+    try:
+      RestServer(('', options['rest']), RestHandler).serve_forever()
+    except KeyboardInterrupt:
+      pass
+    exit(0)
+  if (hmc is None):
+    print("usage: hmc-sim.py [--option=value ...] [ssh options] [user@]hmc [command]", file=sys.stderr)
+    exit(255)
+  if (command is None):
+    exit(0)
+
+  pause(options['latency'])
+  if (hmc in options['down'].split(',') or random.random() < options['ssh-fail-rate']):
+    print(f"ssh: connect to host {hmc} port 22: Connection refused", file=sys.stderr)
+    exit(255)
+
+  try:
+    exit(run_shell(hmc, command))
+  except BrokenPipeError:
+    # the reader was killed or stopped reading
+    exit(141)
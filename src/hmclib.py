@@ -0,0 +1,1086 @@
+# Shared HMC access for vnic-check.py and vnic-move.py: the ssh and HMC REST API transports, the
+#  offline bundle reader, the HMC output parsers and the command metrics.  Keep this file in the
+#  same directory as the scripts.
+# Find the current version on Github at https://github.com/IBM/blog-vios4i
+# See https://blog.vios4i.com for setup and usage instructions
+# Eclipse Public License v2.0
+# license: epl-2.0
+
+import io
+import csv
+import os
+import sys
+import gzip
+import json
+import time
+import atexit
+import shutil
+import ssl
+import tempfile
+import subprocess
+import threading
+import uuid
+import http.client
+import concurrent.futures
+import xml.etree.ElementTree as ET
+from urllib.parse import urlsplit
+from time import sleep
+
+# Settings - each script passes its own values from the settings at its top and its options to setup()
+sshprogram = ['ssh'] # the ssh command and any options to start it with (--ssh)
+transport = 'ssh' # how to ask the HMCs, a key of transports (--transport)
+resturl = 'https://{hmc}:12443' # address of the HMC REST API, {hmc} is replaced by the HMC host name (--rest-url)
+cmdtimeout = 120 # Seconds before a single HMC command is killed
+hmcdeadline = 600 # Seconds each HMC gets for all of its commands, from the time in hmcdeadlines
+maxperhmc = 4 # Maximum number of HMC queries running at the same time on any one HMC
+sshpersist = '10m' # How long an idle shared ssh connection to an HMC is kept open after the last command
+sshretries = 2 # Number of times to retry an HMC command when ssh can not connect
+sshbackoff = 5 # Seconds to wait before the first retry, doubled for each retry after that
+restpasswordfile = os.path.expanduser('~/.vnic-hmc-password') # REST transport: file with the HMC password (or set HMC_PASSWORD)
+restcafile = None # REST transport: file with the CA certificate of the HMC, None to use the system certificates
+restverify = True # REST transport: False to not check the HMC certificate
+restworkers = 4 # REST transport: REST requests run at the same time for one managed system
+cachemetrics = False # True if the script answers queries from a cache, to count the cache hits in the metrics
+healthmetrics = False # True if the script saves the vNIC health of the systems in metrics['systems']
+
+settings = ['sshprogram', 'transport', 'resturl', 'cmdtimeout', 'hmcdeadline', 'maxperhmc', 'sshpersist', 'sshretries',
+            'sshbackoff', 'restpasswordfile', 'restcafile', 'restverify', 'restworkers', 'cachemetrics', 'healthmetrics']
+
+def setup(**values):
+  """sets the settings above, called by each script before it asks an HMC
+
+  Raises TypeError for a name that is not one of the settings
+  """
+
+  for name, value in values.items():
+    if name not in settings:
+      raise TypeError(f"{name} is not a setting of hmclib")
+    globals()[name] = value
+
+# Code from here on:
+
+hmclimits = dict() # HMC name to the semaphore that limits concurrent queries on that HMC
+hmclimitslock = threading.Lock()
+
+def hmcslot(hmc):
+  """returns the semaphore that limits the number of concurrent queries on an HMC to maxperhmc"""
+
+  with hmclimitslock:
+    if hmc not in hmclimits:
+      hmclimits[hmc] = threading.BoundedSemaphore(maxperhmc)
+    return hmclimits[hmc]
+
+
+sshcontroldir = None # private directory for the ssh ControlMaster sockets - created on first use
+sshsockets = dict() # HMC name to the path of its ControlMaster socket
+sshstarted = dict() # HMC name to the time its shared connection was last started
+sshlocks = dict() # HMC name to the lock held while its shared connection is started
+sshlock = threading.Lock()
+
+def hmc_connect(hmc):
+  """Opens the shared ssh connection to an HMC if it is not already open
+
+  The first call for an HMC starts an ssh ControlMaster connection that stays open in the
+  background, so every later command for that HMC is multiplexed over it instead of paying for a
+  new TCP connection, key exchange and HMC login.  If the master connection can not be started,
+  ssh quietly falls back to a normal connection for each command.  A master that has not logged in
+  within the time hmc_timeout allows is killed and HmcError is raised.  A master that has ended (idle
+  for sshpersist, or dropped by the HMC) is started again, at most once a minute.
+
+  Parameter 1 - the hmc host name
+
+  Returns the list of ssh options that send a command over the shared connection.  Raises HmcError
+   if the master connection did not log in in time.
+  """
+
+  global sshcontroldir
+
+  with sshlock:
+    if sshcontroldir is None:
+      sshcontroldir = tempfile.mkdtemp(prefix="vnic")
+      atexit.register(hmc_disconnect_all)
+    if hmc not in sshsockets:
+      sshsockets[hmc] = os.path.join(sshcontroldir,"hmc"+str(len(sshsockets)))
+      sshlocks[hmc] = threading.Lock()
+    hmclock = sshlocks[hmc]
+
+  ctlopts = ["-o","ControlPath="+sshsockets[hmc]]
+
+  with hmclock:
+    if not os.path.exists(sshsockets[hmc]) and time.time() - sshstarted.get(hmc,0) > 60:
+      sshstarted[hmc] = time.time()
+      timeout = hmc_timeout(hmc)
+      # -f backgrounds the master after login, so its output must not be tied to a pipe we wait on
+      try:
+        subprocess.run(sshprogram+[hmc,"-o","BatchMode=yes","-o","ConnectTimeout="+str(max(int(timeout),1)),"-o","ControlMaster=yes","-o","ControlPersist="+sshpersist,"-N","-f"]+ctlopts,
+                       stdin=subprocess.DEVNULL,stdout=subprocess.DEVNULL,stderr=subprocess.DEVNULL,timeout=timeout)
+      except subprocess.TimeoutExpired:
+        # subprocess.run has killed the master, the next commands connect on their own
+        raise HmcError(f"ssh to HMC {hmc} did not log in within {timeout:.0f} seconds")
+
+  return ctlopts
+
+
+def hmc_disconnect_all():
+  """Closes all of the shared ssh connections opened by hmc_connect"""
+
+  for hmc in sshstarted:
+    subprocess.run(sshprogram+[hmc,"-o","ControlPath="+sshsockets[hmc],"-O","exit"],
+                   stdin=subprocess.DEVNULL,stdout=subprocess.DEVNULL,stderr=subprocess.DEVNULL)
+  shutil.rmtree(sshcontroldir,ignore_errors=True)
+
+
+class HmcError(Exception):
+  """raised when an HMC can not be reached, or a command does not finish within its time limit"""
+
+
+hmcdeadlines = dict() # HMC name to the time by which all of its commands for this sweep must be done
+
+def hmc_timeout(hmc):
+  """returns the number of seconds the next command on an HMC may run
+
+  That is cmdtimeout, or less if the deadline for the HMC in hmcdeadlines is closer.  Raises
+  HmcError if the deadline has already passed.
+  """
+
+  deadline = hmcdeadlines.get(hmc)
+  if deadline is None:
+    return cmdtimeout
+  left = deadline - time.time()
+  if (left <= 0):
+    raise HmcError(f"HMC {hmc} did not finish within its {hmcdeadline} second deadline")
+  return min(cmdtimeout, left)
+
+
+def open_hmc_command(hmc, command):
+  """Starts a command on the HMC over the shared ssh connection with its output on a pipe
+
+  The stdout of the returned subprocess.Popen can be read line by line while the command is still
+  running, so large outputs never have to be held in memory as one string.  The command is killed
+  if it runs longer than hmc_timeout allows, which ends its output.  finish_hmc_command must be
+  called when the caller is done with the output.
+
+  Parameter 1 - the hmc host name
+  Parameter 2 - the complete command to run on the HMC
+
+  Returns the subprocess.Popen for the ssh command
+  """
+
+  ctlopts = hmc_connect(hmc)
+  hmcslot(hmc).acquire()
+  try:
+    timeout = hmc_timeout(hmc)
+    process = subprocess.Popen(sshprogram+[hmc,"-o","BatchMode=yes"]+ctlopts+[command],stdin=subprocess.DEVNULL,stdout=subprocess.PIPE,stderr=subprocess.PIPE,encoding="utf-8", universal_newlines=True)
+  except (OSError, HmcError):
+    hmcslot(hmc).release()
+    raise
+
+  process.timeout = timeout
+  process.timedout = False
+  process.timer = threading.Timer(timeout, kill_hmc_command, [process])
+  process.timer.start()
+  return process
+
+
+def kill_hmc_command(process):
+  """kills a command started by open_hmc_command that has run too long"""
+
+  process.timedout = True
+  process.kill()
+
+
+def finish_hmc_command(hmc, process):
+  """Waits for a command started by open_hmc_command to end
+
+  Any output that was not read by the caller is discarded.
+
+  Parameter 1 - the hmc host name
+  Parameter 2 - the subprocess.Popen returned by open_hmc_command
+
+  Returns a tuple of (returncode, stderr).  Raises HmcError if the command was killed because it
+   ran too long.
+  """
+
+  try:
+    stdout, stderr = process.communicate()
+  finally:
+    process.timer.cancel()
+    hmcslot(hmc).release()
+
+  if (process.timedout):
+    raise HmcError(f"command on HMC {hmc} did not finish within {process.timeout:.0f} seconds")
+
+  return (process.returncode, stderr)
+
+
+def stream_hmc_command(hmc, command, consume):
+  """Runs a command on the HMC and passes its output to a function as it is read
+
+  If ssh itself fails (exit code 255, usually because the HMC could not be reached or the login
+  failed) the command is tried again up to sshretries more times, waiting sshbackoff seconds
+  before the first retry and twice as long before each one after that.
+
+  Parameter 1 - the hmc host name
+  Parameter 2 - the complete command to run on the HMC
+  Parameter 3 - a function that is called with the iterable of output lines and returns the parsed data
+
+  Returns a tuple of (parsed data, returncode, stderr).  Raises HmcError if the command ran too long,
+   the HMC deadline passed or ssh still failed after the retries.
+  """
+
+  delay = sshbackoff
+  for trynum in range(sshretries + 1):
+    process = open_hmc_command(hmc,command)
+    try:
+      rtndata = consume(process.stdout)
+    finally:
+      returncode, stderr = finish_hmc_command(hmc,process)
+    if (returncode != 255):
+      return (rtndata, returncode, stderr)
+    if (trynum < sshretries):
+      print(f"ssh to HMC {hmc} failed, retrying in {delay} seconds: {stderr.strip()}")
+      sleep(min(delay, hmc_timeout(hmc)))
+      delay *= 2
+
+  raise HmcError(f"unable to run commands on HMC {hmc}: {stderr.strip()}")
+
+
+def run_hmc_query(hmc, basecmd, namelist, asdict=False):
+  """Runs a query command on HMC and parses output
+  
+  Runs a query command on the specified HMC and parses the output into an array of records
+   that map field names to field values - one array element per line - like a database
+   query function.
+
+ Parameters are passed by position AND keyword hash reference
+   1 (required)  :  The hmc host name where the command should be run
+   2 (required)  :  The base comand to be run.  Usually 'lssyscfg' with some options.
+   3 (required)  :  a reference to an Array of field names to retreive.
+   asdict        :  True to return dictionaries instead of the compact row records
+
+ Returns a list of records of field names to field contents.  One element per line returned
+  by the HMC command.  The records are read only rows from hmc_row_type that are indexed by
+  field name like a dictionary (row['lpar_id']), or dictionaries if asdict is True.
+  Raises HmcError if the HMC could not be reached or did not answer in time.
+
+ Example call:
+      alllpars = run_on_hmc(hmc,
+                            "lssyscfg -r lpar -m sysname ",
+                             ['name',lpar_id','lpar_env','curr_profile','state']
+                             );
+"""
+
+  command = basecmd + ' --header -F ' + '%'.join(namelist);
+
+  # the other transports run a single query as a batch of one
+  if (transport != 'ssh'):
+    rows = run_hmc_queries(hmc, [(basecmd, namelist)])[0]
+    return [row.asdict() for row in rows] if asdict else rows
+
+  stats = {'bytes': 0, 'rows': 0, 'dropped': 0}
+  start = time.time()
+  try:
+    rtndata, returncode, stderr = stream_hmc_command(hmc,command,lambda lines: list(parse_hmc_lines(lines,command,asdict,stats)))
+  except HmcError:
+    record_command(hmc, command, time.time() - start, failed=True)
+    raise
+  record_command(hmc, command, time.time() - start, stats, failed=(returncode != 0))
+  if (returncode != 0):
+    print("Error processing SSH Command: "+command)
+    print(stderr)
+    return([])
+
+  return rtndata
+
+
+def run_hmc_queries(hmc, queries, failed=None):
+  """Runs several query commands on HMC and parses the output of each
+
+  The queries are run by the transport function in transports, ssh_hmc_queries or rest_hmc_queries.
+
+  Parameter 1 - the hmc host name where the commands should be run
+  Parameter 2 - a list of (basecmd, namelist) tuples with the same meaning as the run_hmc_query parameters
+  Parameter 3 - a set to add the indexes of the queries that failed to, or None.  A failed query has
+                 an empty list of records, like a query that found nothing.
+
+  Returns a list with one entry per query, in the same order as the queries.  Each entry is the list of
+   records that run_hmc_query would have returned for that query.  Raises HmcError like run_hmc_query.
+
+  Example call:
+      vnics, ports = run_hmc_queries(hmc, [('lshwres -m sysname -r virtualio --rsubtype vnic', ['lpar_id','slot_num']),
+                                           ('lshwres -m sysname -r sriov --rsubtype physport --level eth', ['adapter_id','phys_port_loc'])])
+  """
+
+  return transports[transport](hmc, queries, failed)
+
+
+def ssh_hmc_queries(hmc, queries, failed=None):
+  """Runs several query commands on HMC in one ssh call and parses the output of each
+
+  This is the ssh transport for run_hmc_queries.  All of the commands are sent to the HMC as one
+  command line, with an echo of a unique marker line before and after each command.  The combined
+  output is then split back apart at the markers and each part is parsed like run_hmc_query, so N
+  queries only cost one round trip to the HMC.
+
+  Parameters and return value are the same as run_hmc_queries.
+  """
+
+  marker = "#VNICBATCH-"+uuid.uuid4().hex
+  commands = []
+  cmdlist = []
+  for i, (basecmd, namelist) in enumerate(queries):
+    command = basecmd + ' --header -F ' + '%'.join(namelist)
+    commands.append(command)
+    cmdlist.append(f"echo '{marker} {i}'; {command}; echo \"{marker} {i} $?\"")
+
+  # the output lines between the start and end markers of each command are parsed as they are read.
+  # Each command is timed from the end of the one before it, so the times add up to the ssh call.
+  def consume(lines):
+    rtndata = [[] for q in queries]
+    rcs = [None for q in queries]
+    stats = [{'bytes': 0, 'rows': 0, 'dropped': 0} for q in queries]
+    seconds = [0.0 for q in queries]
+    mark = start
+    lines = iter(lines)
+    for line in lines:
+      if line.startswith(marker):
+        i = int(line.split()[1])
+        rtndata[i] = list(parse_hmc_lines(hmc_batch_section(lines,marker,rcs,i),commands[i],stats=stats[i]))
+        seconds[i] = time.time() - mark
+        mark = time.time()
+    return (rtndata, rcs, stats, seconds)
+
+  start = time.time()
+  try:
+    (rtndata, rcs, stats, seconds), returncode, stderr = stream_hmc_command(hmc,"; ".join(cmdlist),consume)
+  except HmcError:
+    # the time is shared out between the queries, since there is no telling which one was slow
+    for command in commands:
+      record_command(hmc, command, (time.time() - start) / len(commands), failed=True)
+    raise
+  for i, command in enumerate(commands):
+    record_command(hmc, command, seconds[i], stats[i], failed=(rcs[i] != '0'))
+    if (rcs[i] != '0'):
+      print("Error processing SSH Command: "+command)
+      print(stderr)
+      rtndata[i] = []
+      if (failed is not None):
+        failed.add(i)
+
+  return rtndata
+
+
+restsessions = dict() # HMC name to the X-API-Session token of its REST API session
+restpools = dict() # HMC name to the idle keep-alive connections to its REST API
+restlogonlocks = dict() # HMC name to the lock held while its REST API session is started
+restsystemids = dict() # (HMC name, system name) to the UUID of the managed system in the REST API
+restlock = threading.Lock()
+
+def rest_base(hmc):
+  """returns a tuple of (scheme, host:port, path prefix, user) for the REST API of an HMC from resturl"""
+
+  user, sep, host = hmc.rpartition('@')
+  url = urlsplit(resturl.format(hmc=host))
+  return (url.scheme, url.netloc, url.path.rstrip('/'), user or 'hscroot')
+
+
+def rest_request(hmc, method, path, body=None, headers=dict()):
+  """Sends one request to the REST API of an HMC over a pooled keep-alive connection
+
+  An idle connection to the HMC is reused if there is one, and the connection is put back in the
+  pool when the response has been read, so a sweep only pays for the TLS handshake once for each
+  request running at the same time.  A request that fails on a reused connection (the HMC may have
+  closed it) is tried once more on a new connection.
+
+  Parameter 1 - the hmc name
+  Parameter 2 - the HTTP method
+  Parameter 3 - the path of the request, after the resturl prefix
+  Parameter 4 - the request body or None
+  Parameter 5 - a dictionary of request headers
+
+  Returns a tuple of (HTTP status, response body bytes).  Raises HmcError if the HMC could not be
+   reached or did not answer in time.
+  """
+
+  scheme, netloc, prefix, user = rest_base(hmc)
+  error = None
+  for attempt in range(2):
+    with restlock:
+      idle = restpools.setdefault(hmc, [])
+      conn = idle.pop() if len(idle) > 0 else None
+    if conn is None:
+      if (scheme == 'https'):
+        context = ssl.create_default_context(cafile=restcafile)
+        if not restverify:
+          context.check_hostname = False
+          context.verify_mode = ssl.CERT_NONE
+        conn = http.client.HTTPSConnection(netloc, context=context)
+      else:
+        conn = http.client.HTTPConnection(netloc)
+
+    with hmcslot(hmc):
+      conn.timeout = hmc_timeout(hmc)
+      try:
+        if conn.sock is not None:
+          conn.sock.settimeout(conn.timeout)
+        conn.request(method, prefix+path, body=body, headers=headers)
+        response = conn.getresponse()
+        data = response.read()
+      except (OSError, http.client.HTTPException) as e:
+        conn.close()
+        error = e
+        continue
+
+    if response.will_close:
+      conn.close()
+    else:
+      with restlock:
+        restpools[hmc].append(conn)
+    return (response.status, data)
+
+  raise HmcError(f"REST request {method} {path} to HMC {hmc} failed: {error}")
+
+
+def rest_password(hmc):
+  """returns the password for the REST API from the HMC_PASSWORD environment variable or restpasswordfile"""
+
+  password = os.environ.get('HMC_PASSWORD')
+  if password is None:
+    try:
+      with open(restpasswordfile) as f:
+        password = f.readline().rstrip("\n")
+    except OSError:
+      raise HmcError(f"no password for the REST API of HMC {hmc} - set HMC_PASSWORD or put it in {restpasswordfile}")
+  return password
+
+
+def rest_logon(hmc):
+  """returns the session token for the REST API of an HMC, logging on the first time
+
+  The session is shared by every request to the HMC until the script ends (see rest_logoff_all).
+  """
+
+  with restlock:
+    if hmc in restsessions:
+      return restsessions[hmc]
+    if len(restlogonlocks) == 0:
+      atexit.register(rest_logoff_all)
+    hmclock = restlogonlocks.setdefault(hmc, threading.Lock())
+
+  with hmclock:
+    if hmc not in restsessions:
+      scheme, netloc, prefix, user = rest_base(hmc)
+      request = ET.Element('LogonRequest', {'xmlns': 'http://www.ibm.com/xmlns/systems/power/firmware/web/mc/2012_10/', 'schemaVersion': 'V1_0'})
+      ET.SubElement(request, 'UserID').text = user
+      ET.SubElement(request, 'Password').text = rest_password(hmc)
+      status, data = rest_request(hmc, 'PUT', '/rest/api/web/Logon', ET.tostring(request),
+                                  {'Content-Type': 'application/vnd.ibm.powervm.web+xml; type=LogonRequest',
+                                   'Accept': 'application/vnd.ibm.powervm.web+xml; type=LogonResponse'})
+      if (status != 200):
+        raise HmcError(f"REST API logon to HMC {hmc} as {user} failed with HTTP status {status}")
+      restsessions[hmc] = rest_xml(data).findtext('X-API-Session')
+    return restsessions[hmc]
+
+
+def rest_logoff_all():
+  """Ends the REST API sessions opened by rest_logon and closes the pooled connections"""
+
+  for hmc, token in list(restsessions.items()):
+    try:
+      rest_request(hmc, 'DELETE', '/rest/api/web/Logon', headers={'X-API-Session': token})
+    except HmcError:
+      pass
+  for conns in restpools.values():
+    for conn in conns:
+      conn.close()
+
+
+def rest_xml(data):
+  """parses a REST API response and removes the XML namespaces, so elements can be found by their plain names"""
+
+  root = ET.fromstring(data)
+  for elem in root.iter():
+    elem.tag = elem.tag.rpartition('}')[2]
+  return root
+
+
+def rest_get(hmc, path, stats):
+  """GETs a REST API path and returns the parsed XML, or None if there is no content
+
+  The session is started again once if it has expired.  The size of the response is added to
+  stats['bytes'].  Raises HmcError if the HMC could not be reached or answered with an error.
+  """
+
+  for attempt in range(2):
+    status, data = rest_request(hmc, 'GET', path, headers={'X-API-Session': rest_logon(hmc), 'Accept': 'application/atom+xml'})
+    if (status != 401):
+      break
+    with restlock:
+      restsessions.pop(hmc, None)
+
+  with restlock:
+    stats['bytes'] += len(data)
+  if (status == 204):
+    return None
+  if (status != 200):
+    raise HmcError(f"REST request GET {path} to HMC {hmc} failed with HTTP status {status}")
+  return rest_xml(data)
+
+
+def rest_feed(root):
+  """returns a list of (UUID, object element) for the entries of a REST API feed or single entry"""
+
+  if root is None:
+    return []
+  entries = [root] if root.tag == 'entry' else root.findall('entry')
+  return [(entry.findtext('id'), entry.find('content')[0]) for entry in entries
+          if entry.find('content') is not None and len(entry.find('content')) > 0]
+
+
+def rest_systems(hmc, fetch):
+  """returns the lssyscfg -r sys fields of the managed systems from the REST API ManagedSystem feed"""
+
+  records = []
+  for sysid, system in rest_feed(fetch('/rest/api/uom/ManagedSystem')):
+    mtms = system.find('MachineTypeModelAndSerialNumber')
+    name = system.findtext('SystemName')
+    restsystemids[(hmc, name)] = sysid
+    records.append({'name': name,
+                    'type_model': mtms.findtext('MachineType')+'-'+mtms.findtext('Model'),
+                    'serial_num': mtms.findtext('SerialNumber'),
+                    # the REST API has the states in lower case, like 'operating' and 'power off'
+                    'state': ' '.join(word.capitalize() for word in system.findtext('State', '').split(' '))})
+  return records
+
+
+def rest_system_id(hmc, sysname, fetch):
+  """returns the REST API UUID of a managed system, reading the ManagedSystem feed if it is not known yet"""
+
+  if (hmc, sysname) not in restsystemids:
+    rest_systems(hmc, fetch)
+  if (hmc, sysname) not in restsystemids:
+    raise HmcError(f"managed system {sysname} was not found in the REST API of HMC {hmc}")
+  return restsystemids[(hmc, sysname)]
+
+
+def rest_vnics(hmc, sysname, fetch):
+  """returns the lshwres -r virtualio --rsubtype vnic fields of a managed system from the REST API
+
+  The backing_devices and backing_device_states fields are built in the same format the HMC
+  command line uses, so backingdevices and backingstates decode them the same way.  The vNICs of
+  each LPAR are a separate request, so they are read restworkers at a time over the pooled
+  connections.
+  """
+
+  sysid = rest_system_id(hmc, sysname, fetch)
+  vioses = {viosid: (vios.findtext('PartitionName'), vios.findtext('PartitionID'))
+            for viosid, vios in rest_feed(fetch(f'/rest/api/uom/ManagedSystem/{sysid}/VirtualIOServer'))}
+  lpars = rest_feed(fetch(f'/rest/api/uom/ManagedSystem/{sysid}/LogicalPartition'))
+  with concurrent.futures.ThreadPoolExecutor(max_workers=restworkers) as pool:
+    lparvnics = list(pool.map(lambda lpar: rest_feed(fetch(f'/rest/api/uom/LogicalPartition/{lpar[0]}/VirtualNICDedicated')), lpars))
+
+  records = []
+  for (lparid, lpar), vnics in zip(lpars, lparvnics):
+    for vnicid, vnic in vnics:
+      devices = []
+      states = []
+      for bdev in vnic.iter('VirtualNICSRIOVBackingDevice'):
+        vios = bdev.find('AssociatedVirtualIOServer')
+        viosname, viosnum = vioses.get(vios.get('href', '').rpartition('/')[2] if vios is not None else '', ('', ''))
+        logport = bdev.findtext('LogicalPortID', '')
+        devices.append('/'.join(['sriov', viosname, viosnum, bdev.findtext('SRIOVAdapterID', ''), bdev.findtext('PhysicalPortID', ''), logport,
+                                 bdev.findtext('CurrentCapacityPercentage', ''), bdev.findtext('DesiredCapacityPercentage', ''),
+                                 bdev.findtext('FailOverPriority', ''), bdev.findtext('CurrentMaxCapacityPercentage', ''),
+                                 bdev.findtext('DesiredMaxCapacityPercentage', '')]))
+        states.append('/'.join(['sriov', logport, '1' if bdev.findtext('IsActive') == 'true' else '0', bdev.findtext('Status', '')]))
+      records.append({'lpar_name': lpar.findtext('PartitionName'), 'lpar_id': lpar.findtext('PartitionID'),
+                      'slot_num': vnic.findtext('VirtualSlotNumber'),
+                      'auto_priority_failover': '1' if vnic.findtext('AutoPriorityFailover') == 'true' else '0',
+                      'backing_devices': ','.join(devices), 'backing_device_states': ','.join(states)})
+  return records
+
+
+def rest_physports(hmc, sysname, level, fetch):
+  """returns the lshwres -r sriov --rsubtype physport fields of one --level of a managed system from the REST API"""
+
+  porttags = {'eth': 'SRIOVEthernetPhysicalPort', 'ethc': 'SRIOVConvergedNetworkAdapterPhysicalPort', 'roce': 'SRIOVRoCEPhysicalPort'}
+  sysid = rest_system_id(hmc, sysname, fetch)
+  records = []
+  for entryid, system in rest_feed(fetch(f'/rest/api/uom/ManagedSystem/{sysid}')):
+    for adapter in system.iter('SRIOVAdapter'):
+      for port in adapter.iter(porttags.get(level, level)):
+        records.append({'adapter_id': adapter.findtext('AdapterID'), 'phys_port_id': port.findtext('PhysicalPortID'),
+                        'phys_port_label': port.findtext('Label', ''), 'phys_port_sub_label': port.findtext('SubLabel', ''),
+                        'phys_port_loc': port.findtext('LocationCode')})
+  return records
+
+
+def rest_hmc_queries(hmc, queries, failed=None):
+  """Runs the query commands with the HMC REST API instead of ssh
+
+  This is the rest transport for run_hmc_queries.  Each command is mapped to the REST API requests
+  that return the same data, and the results are turned into the same records the command would
+  have returned, so the rest of the script does not know which transport was used.  Only the
+  commands used by the scripts are mapped (lssyscfg -r sys, lshwres -r virtualio --rsubtype vnic
+  and lshwres -r sriov --rsubtype physport).  A REST resource that is needed by more than one of the
+  queries is only read once.  A request that fails raises HmcError, so no query is added to failed.
+
+  Parameters and return value are the same as run_hmc_queries.
+  """
+
+  fetched = dict() # REST path to the parsed response, for this call only
+  stats = {'bytes': 0, 'rows': 0, 'dropped': 0}
+
+  def fetch(path):
+    if path not in fetched:
+      fetched[path] = rest_get(hmc, path, stats)
+    return fetched[path]
+
+  rtndata = []
+  for basecmd, namelist in queries:
+    system, kind = command_tags(basecmd)
+    stats.update(bytes=0, rows=0)
+    start = time.time()
+    try:
+      if (kind == 'lssyscfg sys'):
+        records = rest_systems(hmc, fetch)
+      elif (kind == 'lshwres virtualio vnic'):
+        records = rest_vnics(hmc, system, fetch)
+      elif (kind.startswith('lshwres sriov physport')):
+        records = rest_physports(hmc, system, kind.split()[-1], fetch)
+      else:
+        raise HmcError(f"the REST transport can not run: {basecmd}")
+    except HmcError:
+      record_command(hmc, basecmd, time.time() - start, stats, failed=True)
+      raise
+
+    rowtype = hmc_row_type(namelist)
+    rows = [rowtype([record.get(name, '') for name in namelist]) for record in records]
+    stats['rows'] = len(rows)
+    record_command(hmc, basecmd, time.time() - start, stats)
+    rtndata.append(rows)
+
+  return rtndata
+
+
+transports = {'ssh': ssh_hmc_queries, 'rest': rest_hmc_queries} # transport name to the function that runs a list of queries
+
+
+def hmc_batch_section(lines, marker, rcs, i):
+  """yields the output lines of command i of a run_hmc_queries batch and stores its exit code in rcs[i]"""
+
+  for line in lines:
+    if line.startswith(marker):
+      rcs[i] = line.split()[2]
+      return
+    yield line
+
+
+bundlemarker = "#VNICBUNDLE" # start of the lines that split an offline bundle into its sections
+bundlesections = {'sys': ('lssyscfg -r sys', ['name','type_model','serial_num','state']),
+                  'vnic': ('lshwres -m "$m" -r virtualio --rsubtype vnic', ['lpar_name','lpar_id','slot_num','auto_priority_failover','backing_devices','backing_device_states']),
+                  'eth': ('lshwres -m "$m" -r sriov --rsubtype physport --level eth', ['adapter_id','phys_port_id','phys_port_label','phys_port_sub_label','phys_port_loc']),
+                  'ethc': ('lshwres -m "$m" -r sriov --rsubtype physport --level ethc', ['adapter_id','phys_port_id','phys_port_label','phys_port_sub_label','phys_port_loc']),
+                  'roce': ('lshwres -m "$m" -r sriov --rsubtype physport --level roce', ['adapter_id','phys_port_id','phys_port_label','phys_port_sub_label','phys_port_loc'])
+                 } # offline bundle section name to the query in it, "$m" is the managed system name
+
+def bundle_script():
+  """returns the HMC command line that collects an offline bundle
+
+  The output of this one command line has the HMC host name, the system list, and the vNIC and
+  all of the SRIOV physical port data of every managed system on the HMC.  Each query is in a
+  section that starts with a #VNICBUNDLE-BEGIN line and ends with a #VNICBUNDLE-END line that has
+  its exit code.  The managed systems are listed by the HMC in a for loop, so the same command line
+  works on any HMC.
+  """
+
+  cmdlist = [f"echo '{bundlemarker}-BEGIN hmc'; lshmc -n -F hostname; echo \"{bundlemarker}-END $?\""]
+  syscmdlist = []
+  for kind, (basecmd, namelist) in bundlesections.items():
+    command = basecmd + ' --header -F ' + '%'.join(namelist)
+    if ('"$m"' in basecmd):
+      syscmdlist.append(f"echo \"{bundlemarker}-BEGIN {kind} $m\"; {command}; echo \"{bundlemarker}-END $?\"")
+    else:
+      cmdlist.append(f"echo '{bundlemarker}-BEGIN {kind}'; {command}; echo \"{bundlemarker}-END $?\"")
+  cmdlist.append("for m in $(lssyscfg -r sys -F name); do "+"; ".join(syscmdlist)+"; done")
+  return "; ".join(cmdlist)
+
+
+def open_hmc_output(filename):
+  """opens a file of saved HMC output, like an offline bundle, to be read one line at a time
+
+  A gzip compressed file is uncompressed as it is read, so even a very large capture is never all
+  in memory.  Windows line ends (from a cut and paste) are read as normal line ends.
+
+  Parameter 1 - the file name, or '-' for stdin
+
+  Returns an open text file.  Raises OSError if the file can not be opened.
+  """
+
+  raw = sys.stdin.buffer if filename == '-' else open(filename, "rb")
+  if (raw.peek(2)[:2] == b'\x1f\x8b'):
+    raw = gzip.GzipFile(fileobj=raw, mode="rb")
+  return io.TextIOWrapper(raw, encoding="utf-8", errors="replace")
+
+
+def read_bundle(lines, wanted=None):
+  """Reads an offline bundle from bundle_script in one pass
+
+  This is a generator that yields each section of the bundle as soon as it has been read, so only
+  one section at a time is in memory.  Lines outside of the sections, like the command line itself
+  in a cut and paste of an HMC session, are ignored.
+
+  Parameter 1 - an iterable of the bundle lines, like a file from open_hmc_output
+  Parameter 2 - a function of (kind, name) that returns True for the sections to read, or None for
+                 all of them.  The other sections are skipped without being parsed.
+
+  Yields a tuple of (kind, name, rows) for each section:
+    kind - 'hmc' or a key of bundlesections
+    name - the managed system name for the sections of a system, otherwise None
+    rows - the records in the format returned by run_hmc_query, or the lines of the HMC host name
+            for 'hmc'.  rows is None if the command failed or the bundle ends before the section does.
+  """
+
+  lines = iter(lines)
+  line = next(lines, None)
+  while line is not None:
+    if not line.startswith(bundlemarker+"-BEGIN "):
+      line = next(lines, None)
+      continue
+    words = line.split(None, 2)
+    kind = words[1]
+    name = words[2].strip() if len(words) > 2 else None
+    end = dict()
+    section = bundle_section(lines, end)
+
+    if (kind != 'hmc' and kind not in bundlesections) or (wanted is not None and not wanted(kind, name)):
+      # a section that is not needed, or from a newer version of the scripts
+      for skipped in section:
+        pass
+    else:
+      if (kind == 'hmc'):
+        command = 'lshmc -n -F hostname'
+        rows = [hmcline.strip() for hmcline in section if hmcline.strip() != '']
+      else:
+        basecmd, namelist = bundlesections[kind]
+        command = basecmd.replace('"$m"', name or '') + ' --header -F ' + '%'.join(namelist)
+        rows = list(parse_hmc_lines(section, command))
+      if ('rc' not in end):
+        print(f"WARNING: the bundle ends in the middle of the output of: {command}")
+      if (end.get('rc') != '0'):
+        rows = None
+      yield (kind, name, rows)
+
+    line = end['next'] if 'next' in end else next(lines, None)
+
+
+def bundle_section(lines, end):
+  """yields the lines of one section of an offline bundle and saves how it ended in end
+
+  end['rc'] is set to the exit code from the -END line.  If a -BEGIN line comes first because the
+  -END line is missing, that line is saved in end['next'] instead.
+  """
+
+  for line in lines:
+    if line.startswith(bundlemarker+"-END"):
+      words = line.split()
+      end['rc'] = words[1] if len(words) > 1 else ''
+      return
+    if line.startswith(bundlemarker+"-BEGIN "):
+      end['next'] = line
+      return
+    yield line
+
+
+metrics = {'commands': dict(), 'phases': dict(), 'systems': dict()} # the counters written by write_metrics
+metricsstart = time.time()
+metricslock = threading.Lock()
+
+def command_tags(command):
+  """returns a tuple of (system name, command type) for an HMC command, for the metrics
+
+  The command type is the command name with its -r, --rsubtype and --level values, like
+  'lshwres virtualio vnic'.  The system name is the -m value, or '' for HMC wide commands.
+  """
+
+  words = command.split()
+  system = ''
+  kind = words[:1]
+  for opt, value in zip(words, words[1:]):
+    if (opt == '-m'):
+      system = value
+    elif (opt in ('-r','--rsubtype','--level')):
+      kind.append(value)
+  return (system, ' '.join(kind))
+
+
+def record_command(hmc, command, seconds, stats=None, failed=False, cached=False):
+  """adds one HMC command to the metrics
+
+  Parameter 1 - the hmc host name
+  Parameter 2 - the command, only the command name and options are used
+  Parameter 3 - the wall time of the command in seconds
+  Parameter 4 - the dictionary of 'bytes', 'rows' and 'dropped' counts filled in by parse_hmc_lines
+  failed      - True if the command failed or timed out
+  cached      - True if the result came from the cache instead of the HMC, only with cachemetrics
+  """
+
+  system, kind = command_tags(command)
+  with metricslock:
+    entry = metrics['commands'].get((hmc, system, kind))
+    if entry is None:
+      entry = metrics['commands'][(hmc, system, kind)] = {'count': 0, 'seconds': 0.0, 'bytes': 0, 'rows': 0,
+                                                         'dropped': 0, 'failures': 0}
+      if (cachemetrics):
+        entry['cached'] = 0
+    entry['count'] += 1
+    entry['seconds'] += seconds
+    for name in ('bytes', 'rows', 'dropped'):
+      entry[name] += (stats or dict()).get(name, 0)
+    entry['failures'] += int(failed)
+    if (cached):
+      entry['cached'] += 1
+
+
+def record_phase(phase, seconds):
+  """adds the wall time of one phase of the run (like 'collect' or 'check') to the metrics"""
+
+  with metricslock:
+    metrics['phases'][phase] = metrics['phases'].get(phase, 0.0) + seconds
+
+
+def prom_label(value):
+  """returns a value escaped for a Prometheus label"""
+
+  return str(value).replace('\\','\\\\').replace('"','\\"').replace('\n','\\n')
+
+
+def write_metrics(jsonfile, promfile, prefix):
+  """Writes the metrics as a JSON run summary and as a Prometheus textfile collector file
+
+  Both files are written to a temporary file that is renamed into place, so the node_exporter
+  textfile collector never reads a partly written file.  The counters cover the whole time this
+  script has been running.
+
+  Parameter 1 - the JSON file name, or None for no JSON file
+  Parameter 2 - the Prometheus file name (it must end in .prom for the collector to read it), or None
+  Parameter 3 - the prefix for the Prometheus metric names
+  """
+
+  if (jsonfile is None and promfile is None):
+    return
+
+  with metricslock:
+    now = time.time()
+    summary = {'started': metricsstart, 'seconds': now - metricsstart,
+               'commands': [dict(hmc=key[0], system=key[1], type=key[2], **entry) for key, entry in sorted(metrics['commands'].items())],
+               'phases': dict(metrics['phases'])}
+    if (healthmetrics):
+      summary['systems'] = [dict(hmc=key[0], system=key[1], **entry) for key, entry in sorted(metrics['systems'].items())]
+
+  prom = []
+  def metric(name, mtype, helptext, samples):
+    prom.append(f"# HELP {prefix}_{name} {helptext}")
+    prom.append(f"# TYPE {prefix}_{name} {mtype}")
+    for labels, value in samples:
+      labeltext = ','.join(f'{label}="{prom_label(labelvalue)}"' for label, labelvalue in labels)
+      prom.append(f"{prefix}_{name}{{{labeltext}}} {value}" if labeltext != '' else f"{prefix}_{name} {value}")
+
+  metric('start_time_seconds', 'gauge', 'Time this script started', [((), summary['started'])])
+  metric('run_seconds', 'gauge', 'Seconds this script has been running', [((), round(summary['seconds'], 3))])
+  cmdfields = [('count', 'commands_total', 'HMC commands run'),
+               ('seconds', 'command_seconds_total', 'Wall time of the HMC commands'),
+               ('bytes', 'command_bytes_total', 'Bytes of output read from the HMC commands'),
+               ('rows', 'command_rows_total', 'Rows parsed from the HMC command output'),
+               ('dropped', 'command_dropped_lines_total', 'Malformed output lines that were skipped'),
+               ('failures', 'command_failures_total', 'HMC commands that failed or timed out')]
+  if (cachemetrics):
+    cmdfields.append(('cached', 'command_cache_hits_total', 'HMC queries answered from the cache'))
+  for field, name, helptext in cmdfields:
+    metric(name, 'counter', helptext, [((('hmc', c['hmc']), ('system', c['system']), ('type', c['type'])), round(c[field], 3))
+                                       for c in summary['commands']])
+  metric('phase_seconds_total', 'counter', 'Wall time of each phase of the run',
+         [((('phase', phase),), round(seconds, 3)) for phase, seconds in sorted(summary['phases'].items())])
+  sysfields = [('checked', 'system_checked', '1 if the last check of the system completed, 0 if it was not checked'),
+               ('vnics', 'system_vnics', 'vNICs on the system'),
+               ('backingdevices', 'system_backing_devices', 'vNIC backing devices on the system'),
+               ('operational', 'system_operational_backing_devices', 'Operational vNIC backing devices on the system'),
+               ('vnicproblems', 'system_vnics_with_problems', 'vNICs with at least one problem'),
+               ('problems', 'system_problems', 'Problems found on the system')]
+  for field, name, helptext in sysfields:
+    samples = [((('hmc', s['hmc']), ('system', s['system'])), s[field]) for s in summary.get('systems', []) if field in s]
+    if (len(samples) > 0):
+      metric(name, 'gauge', helptext, samples)
+  samples = [((('hmc', s['hmc']), ('system', s['system']), ('check', rule)), count)
+             for s in summary.get('systems', []) for rule, count in sorted(s.get('rules', dict()).items())]
+  if (len(samples) > 0):
+    metric('system_check_problems', 'gauge', 'Problems found on the system by each vNIC check', samples)
+
+  for filename, text in ((jsonfile, json.dumps(summary, indent=1)), (promfile, "\n".join(prom))):
+    if (filename is None):
+      continue
+    try:
+      fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filename)), suffix=".tmp")
+      with os.fdopen(fd, "w") as f:
+        f.write(text+"\n")
+      os.chmod(tmpname, 0o644)
+      os.replace(tmpname, filename)
+    except OSError as e:
+      print(f"WARNING: unable to write metrics file {filename}: {e}")
+
+
+hmcrowtypes = dict() # header tuple to the row type built by hmc_row_type
+
+def hmc_row_type(hdr):
+  """returns the compact record type for the rows of an HMC query with the specified header
+
+  The rows are tuples of the field values.  One type is built for each distinct header and all of
+  its rows share one field name to position map, so a row costs no more memory than a tuple but
+  can still be used like the dictionaries the scripts have always used - row['lpar_id'],
+  row.get('lpar_id') and row.asdict() all work.
+
+  Parameter 1 - the list of field names from the header line
+  """
+
+  hdr = tuple(hdr)
+  rowtype = hmcrowtypes.get(hdr)
+  if rowtype is None:
+    index = {name: i for i, name in enumerate(hdr)}
+
+    class HmcRow(tuple):
+      __slots__ = ()
+      fields = hdr
+
+      def __getitem__(self, key):
+        if (key.__class__ is str):
+          return tuple.__getitem__(self, index[key])
+        return tuple.__getitem__(self, key)
+
+      def get(self, key, default=None):
+        i = index.get(key)
+        return default if i is None else tuple.__getitem__(self, i)
+
+      def asdict(self):
+        return dict(zip(hdr, self))
+
+    rowtype = hmcrowtypes[hdr] = HmcRow
+
+  return rowtype
+
+
+def parse_hmc_lines(lines, command, asdict=False, stats=None):
+  """Parses HMC query output that was run with --header and -F with % delimiters
+
+  This is a generator that reads the output one line at a time from any iterable of lines
+  (a pipe, an open file or a list) and yields one record per data line as it is read.  Lines that
+  do not have the same number of fields as the header are skipped, counted and reported.
+
+  Parameter 1 - an iterable of output lines, with the header on the first line
+  Parameter 2 - the command that produced the output, for the malformed line report
+  Parameter 3 - True to yield dictionaries instead of hmc_row_type records
+  Parameter 4 - a dictionary to add the 'bytes', 'rows' and 'dropped' counts of the output to, or None
+  """
+
+  hdr = None
+  malformed = 0
+  noresults = False
+  nbytes = 0
+  rows = 0
+
+  for line in lines:
+    nbytes += len(line)
+    line = line.rstrip("\n")
+    if (noresults or line == ''):
+      continue
+    if (hdr is None):
+      if ("No results were found." in line):
+        noresults = True
+        continue
+      hdr = line.split('%')
+      rowtype = hmc_row_type(hdr)
+      fieldcount = len(hdr)
+      continue
+    d = line.split('%')
+    if (len(d) == fieldcount):
+      rows += 1
+      yield dict(zip(hdr,d)) if asdict else rowtype(d)
+    else:
+      malformed += 1
+
+  if (stats is not None):
+    stats['bytes'] += nbytes
+    stats['rows'] += rows
+    stats['dropped'] += malformed
+  if (malformed > 0):
+    print(f"WARNING: {malformed} malformed lines ignored in the output of: {command}")
+
+
+def compile_schema(namelist):
+  """compiles the layout of an HMC structured field into a decoder for that field
+
+  HMC structured fields are a comma seperated list of items that are each a slash delimited list of
+  values.  The field names are only looked up once here, and the returned decoder turns each item
+  into a fixed layout hmc_row_type record in a single pass over the data.  Items with fewer values
+  than the layout are padded with empty strings and extra values are ignored.  Fields that use the
+  HMC double quoting (like virtual_fc_adapters, where the wwpns inside an item are comma seperated)
+  are split with the csv module so the quoted commas stay inside their item.
+
+  Parameter 1 - An ordered list of the field names for the slash delimited values of each list item
+
+  Returns a function that takes the field data and returns a list of records, one per list item
+
+  Example Call: backingstate = compile_schema(['sriov','sriov-logical-port-ID','active','status'])(vnic['backing_device_states'])
+
+  Example of  the format processed:
+    sriov/2701c001/1/Operational,sriov/27018001/0/Operational,sriov/27018002/0/NotOperational
+
+  Example of output from that data (shown with asdict()):
+    [{'sriov': 'sriov', 'sriov-logical-port-ID': '2701c001', 'active': '1', 'status': 'Operational'}, {'sriov': 'sriov', 'sriov-logical-port-ID': '27018001', 'active': '0', 'status': 'Operational'}, {'sriov': 'sriov', 'sriov-logical-port-ID': '27018002', 'active': '0', 'status': 'NotOperational'}]
+
+  """
+
+  rowtype = hmc_row_type(namelist)
+  fieldcount = len(namelist)
+  padding = ('',) * fieldcount
+
+  def decode(data):
+    if (data in ('', 'none', 'null')):
+      return []
+
+    if ('"' in data):
+      groups = next(csv.reader([data]))
+      # a field that is quoted as a whole has its items quoted again inside it
+      while (len(groups) == 1 and '"' in groups[0] and groups[0] != data):
+        data = groups[0]
+        groups = next(csv.reader([data]))
+    else:
+      groups = data.split(',')
+
+    rtndata = []
+    for group in groups:
+      d = group.split('/')
+      if (len(d) != fieldcount):
+        d = (tuple(d) + padding)[:fieldcount]
+      rtndata.append(rowtype(d))
+    return rtndata
+
+  return decode
+
+
+# Decoders for the HMC structured fields used by the scripts
+backingdevicefields = ['sriov','vios-lpar-name','vios-lpar-ID','sriov-adapter-ID','sriov-physical-port-ID','sriov-logical-port-ID',
+  'current-capacity','desired-capacity','failover-priority','current-max-capacity','desired-max-capacity']
+backingstatefields = ['sriov','sriov-logical-port-ID','active','status']
+backingdevices = compile_schema(backingdevicefields)
+backingstates = compile_schema(backingstatefields)
+
+
+def byprty(bdev):
+  """sort function to allow sorting of backing device records by failover-priority
+
+  The priorities are sorted as numbers, so 9 comes before 10.  A priority that is empty or not a
+  number (from a malformed HMC record) sorts after all of the others instead of failing the sort.
+  """
+
+  prty = bdev['failover-priority']
+  return int(prty) if prty.isdigit() else sys.maxsize
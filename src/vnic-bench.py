@@ -0,0 +1,222 @@
+#!/QOpensys/pkgs/bin/python3
+
+# Benchmarks vnic-check.py and vnic-move.py against the hmc-sim.py HMC simulator and prints the
+#  run time, HMC query latency and peak memory of each.
+# Find the current version on Github at https://github.com/IBM/blog-vios4i
+# See https://blog.vios4i.com for setup and usage instructions
+# Eclipse Public License v2.0
+# license: epl-2.0
+
+import os
+import sys
+import json
+import time
+import shlex
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+description = """Benchmarks vnic-check.py and vnic-move.py against the hmc-sim.py HMC simulator
+
+Every scenario is run --runs times as its own process, with the simulator in place of ssh, and the
+wall time, the peak memory (maximum resident set size) and the per query HMC latency from the
+--metrics-json file of the script are reported.  The simulated fleet is the same for the same
+options, so the numbers can be compared between versions of the scripts.
+
+The scenarios are:
+  check              vnic-check.py --refresh, every query goes to the HMC
+  check-cached       vnic-check.py using the cached system list and SRIOV port data
+  move-drain         vnic-move.py --verify draining the first VIOS of every system on the first HMC
+  move-autofailover  vnic-move.py --verify setting auto_priority_failover on every system on the first HMC
+
+Example:
+  vnic-bench.py --hmcs 2 --systems 20 --lpars 100 --latency 0.3 --runs 5 --json bench.json
+"""
+
+scenarios = ['check', 'check-cached', 'move-drain', 'move-autofailover']
+
+# Code from here on:
+
+scriptdir = os.path.dirname(os.path.abspath(__file__))
+
+
+def measure(resultfile, script, scriptargs):
+  """Runs a script in this process and saves its exit code, wall time and peak memory
+
+  This is run as a child process of the benchmark for every run, so the peak memory is the peak of
+  that one script and not of the simulator processes it starts.
+
+  Parameter 1 - the file to write the JSON result to
+  Parameter 2 - the script to run
+  Parameter 3 - the list of arguments for the script
+  """
+
+  import runpy
+  import resource
+
+  sys.argv = [script] + scriptargs
+  start = time.time()
+  try:
+    runpy.run_path(script, run_name='__main__')
+    rc = 0
+  except SystemExit as e:
+    rc = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+  seconds = time.time() - start
+
+  # ru_maxrss is in kilobytes, except on macOS where it is in bytes
+  maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  if (sys.platform != 'darwin'):
+    maxrss *= 1024
+
+  with open(resultfile, "w") as f:
+    json.dump({'rc': rc, 'seconds': seconds, 'maxrss': maxrss}, f)
+  # the atexit handlers of the script (like its --metrics-json file) run when this exits
+  sys.exit(rc)
+
+
+def sim_command(args, faults=True):
+  """returns the --ssh command line that runs hmc-sim.py with the fleet options
+
+  With faults False the latency options and --sim-option are left out.
+  """
+
+  simargs = [sys.executable, os.path.join(scriptdir, "hmc-sim.py"),
+             f"--systems={args.systems}", f"--lpars={args.lpars}", f"--vnics={args.vnics}", f"--backing={args.backing}",
+             f"--fail-rate={args.fail_rate}"]
+  if (faults):
+    simargs += [f"--latency={args.latency}", f"--cmd-latency={args.cmd_latency}", f"--row-latency={args.row_latency}"] + (args.sim_option or [])
+  return ' '.join(shlex.quote(a) for a in simargs)
+
+
+def system_list(args, hmc):
+  """returns the names of the managed systems that the simulator has on an HMC"""
+
+  process = subprocess.run(shlex.split(sim_command(args, faults=False)) + [hmc, "lssyscfg -r sys -F name"],
+                           stdout=subprocess.PIPE, universal_newlines=True, check=True)
+  return process.stdout.split()
+
+
+def scenario_command(args, scenario, metricsfile):
+  """returns the script and its argument list for one run of a scenario"""
+
+  hmcs = [f"sim{n+1}" for n in range(args.hmcs)]
+  common = ["--ssh", sim_command(args), "--metrics-json", metricsfile]
+  if (scenario == 'check'):
+    return ("vnic-check.py", ["--refresh", "--hmc", ','.join(hmcs)] + common)
+  if (scenario == 'check-cached'):
+    return ("vnic-check.py", ["--hmc", ','.join(hmcs)] + common)
+  systems = ','.join(system_list(args, hmcs[0]))
+  if (scenario == 'move-drain'):
+    return ("vnic-move.py", ["--hmc", hmcs[0], "--system", systems, "--vios", "*-vios1", "--verify"] + common)
+  return ("vnic-move.py", ["--hmc", hmcs[0], "--system", systems, "--autofailover", "0", "--verify"] + common)
+
+
+def run_scenario(args, scenario, workdir):
+  """runs one scenario --runs times and returns a dictionary of the results
+
+  The results have the wall times and peak memory of every run, and the HMC commands of all of the
+  runs added up by command type.
+  """
+
+  metricsfile = os.path.join(workdir, "metrics.json")
+  script, scriptargs = scenario_command(args, scenario, metricsfile)
+  result = {'scenario': scenario, 'runs': [], 'commands': dict()}
+
+  for run in range(args.runs):
+    resultfile = os.path.join(workdir, "result.json")
+    outfile = os.path.join(workdir, "output.txt")
+    if os.path.exists(metricsfile):
+      os.remove(metricsfile)
+    with open(outfile, "w") as out:
+      subprocess.run([sys.executable, os.path.abspath(__file__), "--measure", resultfile, os.path.join(scriptdir, script)] + scriptargs,
+                     stdin=subprocess.DEVNULL, stdout=out, stderr=subprocess.STDOUT, env=dict(os.environ, HOME=workdir))
+    with open(resultfile) as f:
+      runresult = json.load(f)
+    result['runs'].append(runresult)
+
+    if (runresult['rc'] != 0):
+      with open(outfile) as f:
+        print(f"WARNING: {scenario} run {run+1} ended with exit code {runresult['rc']}:")
+        print(''.join(f.readlines()[-10:]))
+
+    if not os.path.exists(metricsfile):
+      continue
+    with open(metricsfile) as f:
+      for cmd in json.load(f)['commands']:
+        total = result['commands'].setdefault(cmd['type'], {'count': 0, 'seconds': 0.0, 'bytes': 0, 'rows': 0, 'failures': 0, 'cached': 0})
+        # vnic-move.py has no cache, so its commands have no 'cached' count
+        for name in total:
+          total[name] += cmd.get(name, 0)
+
+  return result
+
+
+def print_results(results):
+  """prints the results of all of the scenarios as tables"""
+
+  print(f"\n{'Scenario':<18} {'Runs':>4} {'Wall min':>9} {'Wall avg':>9} {'Wall max':>9} {'Peak RSS':>9} {'Queries':>8} {'Avg query':>10}")
+  for result in results:
+    walls = [r['seconds'] for r in result['runs']]
+    maxrss = max(r['maxrss'] for r in result['runs'])
+    queries = sum(c['count'] - c['cached'] for c in result['commands'].values())
+    seconds = sum(c['seconds'] for c in result['commands'].values())
+    avgquery = f"{seconds / queries * 1000:.1f}ms" if queries > 0 else "-"
+    print(f"{result['scenario']:<18} {len(walls):>4} {min(walls):>8.2f}s {sum(walls)/len(walls):>8.2f}s {max(walls):>8.2f}s "
+          f"{maxrss/1024/1024:>7.1f}MB {queries // len(walls):>8} {avgquery:>10}")
+
+  print(f"\n{'Scenario':<18} {'Command type':<30} {'Queries':>8} {'Avg':>10} {'Bytes':>10} {'Rows':>8} {'Failed':>7} {'Cached':>7}")
+  for result in results:
+    runs = len(result['runs'])
+    for kind, c in sorted(result['commands'].items()):
+      queries = c['count'] - c['cached']
+      avg = f"{c['seconds'] / queries * 1000:.1f}ms" if queries > 0 else "-"
+      print(f"{result['scenario']:<18} {kind:<30} {queries // runs:>8} {avg:>10} {c['bytes'] // runs:>10} {c['rows'] // runs:>8} "
+            f"{c['failures'] // runs:>7} {c['cached'] // runs:>7}")
+
+
+#
+## Start of Mainline
+#
+
+if __name__ == '__main__':
+  # the benchmark runs itself with --measure to run each script and measure it
+  if (len(sys.argv) > 3 and sys.argv[1] == '--measure'):
+    measure(sys.argv[2], sys.argv[3], sys.argv[4:])
+
+  parser = argparse.ArgumentParser(description=description, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument("--hmcs",help="Number of simulated HMCs for vnic-check.py (default 2)",type=int,default=2)
+  parser.add_argument("--systems",help="Managed systems on each HMC (default 10)",type=int,default=10)
+  parser.add_argument("--lpars",help="Client LPARs with vNICs on each system (default 40)",type=int,default=40)
+  parser.add_argument("--vnics",help="vNICs on each client LPAR (default 1)",type=int,default=1)
+  parser.add_argument("--backing",help="Backing devices on each vNIC (default 2)",type=int,default=2)
+  parser.add_argument("--fail-rate",help="Fraction of the backing devices that are not operational (default 0.05)",type=float,default=0.05)
+  parser.add_argument("--latency",help="Seconds the simulator adds to every ssh call (default 0)",type=float,default=0.0)
+  parser.add_argument("--cmd-latency",help="Seconds the simulator adds to every HMC command (default 0)",type=float,default=0.0)
+  parser.add_argument("--row-latency",help="Seconds the simulator adds for every output row (default 0)",type=float,default=0.0)
+  parser.add_argument("--sim-option",help="Any other hmc-sim.py option, like --sim-option=--error-rate=0.01 - can be repeated",action="append")
+  parser.add_argument("--runs",help="Number of times to run each scenario (default 3)",type=int,default=3)
+  parser.add_argument("--scenario",help="Scenario to run - can be repeated (default all of them)",choices=scenarios,action="append")
+  parser.add_argument("--json",help="Also write the results to this JSON file")
+  args = parser.parse_args()
+
+  if (args.runs < 1):
+    parser.error("--runs must be at least 1")
+
+  # the cache of vnic-check.py goes in a private HOME, so check-cached uses the data from check
+  workdir = tempfile.mkdtemp(prefix="vnicbench")
+  try:
+    results = []
+    for scenario in (args.scenario or scenarios):
+      if (scenario == 'check-cached' and 'check' not in [r['scenario'] for r in results]):
+        run_scenario(argparse.Namespace(**dict(vars(args), runs=1)), 'check', workdir)
+      print(f"Running {scenario} {args.runs} times", flush=True)
+      results.append(run_scenario(args, scenario, workdir))
+  finally:
+    shutil.rmtree(workdir, ignore_errors=True)
+
+  print_results(results)
+
+  if (args.json != None):
+    with open(args.json, "w") as f:
+      json.dump({'options': vars(args), 'results': results}, f, indent=1)
@@ -9,9 +9,36 @@
 # license: epl-2.0 
 
 import io
+import os
+import sys
+import json
+import itertools
+import contextlib
+import time
+import hashlib
+import bisect
+import fcntl
+import argparse
+import atexit
+import shlex
+import signal
 import smtplib
-import subprocess
+import tempfile
+import queue
+import threading
+import concurrent.futures
+import http.client
+from urllib.parse import urlsplit
 from time import sleep
+import hmclib # the HMC access shared with vnic-move.py, keep hmclib.py in the same directory as this script
+from hmclib import (HmcError, run_hmc_query, run_hmc_queries, open_hmc_output, read_bundle, bundle_script,
+                    hmc_row_type, backingdevices, backingdevicefields, backingstates, backingstatefields, byprty,
+                    metrics, metricslock, record_command, record_phase, write_metrics, hmcdeadlines)
+
+try:
+  import numpy
+except ImportError:
+  numpy = None # the vNICs are then checked one at a time with check_vnic
 
 # Parameters that you can change to meet your requirements
 
@@ -20,214 +47,1603 @@ from time import sleep
 smtphost = None # replace None with your smtphost name or IP address. 127.0.0.1 for a local mailserver
 sender = 'senderaddress@yourdomain.tld'  # Sender address for email - probably needs to be a valid address in your domain
 toaddrs = ['youraddress@yourdomain.tld'] # List of addresses that should get an email - seperate with commas
+notifysinks = ['smtp', 'file', 'webhook'] # Where reports are sent: 'smtp' to toaddrs on smtphost, 'file' to notifyfile and 'webhook' to notifyurl, when they are set
+notifyfile = None # File the reports are added to in mbox format, None for no file
+notifyurl = None # URL the reports are posted to as JSON, like 'http://127.0.0.1:8080/vnic', None for no webhook
+spooldir = os.path.expanduser('~/.vnic-check-spool') # Directory for reports that are not sent yet, they are sent by the next run if this one can not, None to disable
+smtptimeout = 30 # Seconds before a connection to smtphost or notifyurl is given up
+notifybackoff = 5 # Seconds to wait before sending a report again after a failure, doubled for each failure after that
+notifybackoffmax = 300 # Longest time in seconds to wait between tries
+notifywait = 10 # Seconds the script waits for reports to be sent when it ends, the rest are sent by the next run
+notifybatch = 60 # --daemon: seconds to wait for more reports to send together with a new one
 
 hmcs = ['monitor@hmcaddress'] # List of hmc user@address, seperate multiple entries with commas
 
 minopercount=2 # Required minimum number of operational backing devices per vNIC
+vectorize=True # Check all of the vNICs of a system together with NumPy arrays when NumPy is installed, False to check them one at a time
 
-# Code from here on:
+maxworkers=8 # Maximum number of HMC queries running at the same time across all HMCs
+maxperhmc=4  # Maximum number of HMC queries running at the same time on any one HMC
+maxprocesses=None # --archive: Maximum number of bundles checked at the same time, None for one per CPU
+
+sshpersist='10m' # How long an idle shared ssh connection to an HMC is kept open after the last command
+
+cachedir = os.path.expanduser('~/.vnic-check-cache') # Directory to keep HMC data that seldom changes between runs, None to disable
+cachettl = {'sys': 3600, 'physport': 86400} # Seconds the cached system list and SRIOV physical port data are used before asking the HMC again
+cachemaxbytes = 10*1024*1024 # Largest size of the cache directory, the oldest entries are removed first
+
+cmdtimeout = 120 # Seconds before a single HMC command is killed
+hmcdeadline = 600 # Seconds each HMC gets for all of its commands in one check, systems not done by then are reported as not checked
+sshretries = 2 # Number of times to retry an HMC command when ssh can not connect
+sshbackoff = 5 # Seconds to wait before the first retry, doubled for each retry after that
+
+pollmin = 15  # --daemon: seconds between polls of a system that has problems or just changed
+pollmax = 300 # --daemon: longest time in seconds between polls of a healthy system
+
+hmctransport = 'ssh' # How to ask the HMCs: 'ssh' for the HMC command line or 'rest' for the HMC REST API
+resturl = 'https://{hmc}:12443' # REST transport: address of the HMC REST API, {hmc} is replaced by the HMC host name
+restpasswordfile = os.path.expanduser('~/.vnic-hmc-password') # REST transport: file with the HMC password (or set HMC_PASSWORD) - make it readable only by you
+restcafile = None # REST transport: file with the CA certificate of the HMC, None to use the system certificates
+restverify = True # REST transport: False to not check the HMC certificate, only for a self-signed HMC certificate you trust
+restworkers = 4 # REST transport: REST requests run at the same time for one managed system
+
+historydir = os.path.expanduser('~/.vnic-check-history') # Directory for the history of backing device states and problems, None to disable
+historyretention = 30*86400 # Seconds of state changes kept in the history, older ones are removed once a day
+flapwindow = 86400 # Seconds over which backing device state changes are counted to find flapping devices
+flapcount = 2 # A backing device that changed state more than this many times in flapwindow seconds is flapping
+
+metricsjson = None # File for a JSON summary of the HMC command timings and system health after each run, None for no file
+metricsprom = None # File for the Prometheus node_exporter textfile collector, like '/var/lib/node_exporter/vnic.prom', None for no file
+
+description="""Checks all of the vNIC configurations for all systems on the configured HMCs and prints or
+emails the results if there are any problems.
+
+The system list and the SRIOV physical port data seldom change, so they are kept in a local cache
+(see cachedir and cachettl at the top of this script) and only the vNIC data is read from the HMC on
+every run.  Use --refresh to ignore the cache and read everything from the HMC.
 
-def run_hmc_query(hmc, basecmd, namelist):
-  """Runs a query command on HMC and parses output
-  
-  Runs a query command on the specified HMC and parses the output into an array of hashes
-   that map field names to field values - one array element per line - like a database
-   query function.
-
- Parameters are passed by position AND keyword hash reference
-   1 (required)  :  The hmc host name where the command should be run
-   2 (required)  :  The base comand to be run.  Usually 'lssyscfg' with some options.
-   3 (required)  :  a reference to an Array of field names to retreive.
-
- Returns a list of disctionaries of field names to field contents.  One element per line returned
-  by the HMC command.
-
- Example call:
-      alllpars = run_on_hmc(hmc,
-                            "lssyscfg -r lpar -m sysname ",
-                             ['name',lpar_id','lpar_env','curr_profile','state']
-                             );
+With --daemon the script keeps running instead of checking once.  Each system is polled every
+pollmin seconds while it has problems and less often (up to every pollmax seconds) while it is
+healthy, and a report is only sent when problems appear or clear.
+
+A command on an HMC is killed after cmdtimeout seconds and each HMC has hmcdeadline seconds for
+all of its commands in one check.  Systems that can not be read in that time, or whose HMC can not
+be reached after sshretries retries, are reported as not checked instead of holding up the report.
+
+Every HMC command is timed and its output bytes, rows, malformed lines and failures are counted by
+HMC, system and command type, along with the time spent in each phase of the run and the vNIC
+health of every system.  Use --metrics-json and --metrics-prom (or metricsjson and metricsprom at
+the top of this script) to write them out after every run, or every poll with --daemon.
+
+With --transport rest the HMC REST API is used instead of ssh.  One session is started for each
+HMC (the user is the part of the HMC name before the @, the password is read from the HMC_PASSWORD
+environment variable or restpasswordfile) and the requests share a pool of keep-alive connections.
+
+For an HMC that can not be reached from where this script runs, --offline prints one command that
+collects everything this script needs from every system on an HMC (an offline bundle).  Run it on
+the HMC, save the output (gzip compressed if you like) and check it with --bundle, for example:
+  ssh hscroot@hmc1 "$(vnic-check.py --offline)" | gzip > hmc1.bundle.gz
+  vnic-check.py --bundle hmc1.bundle.gz --bundle hmc2.bundle.txt
+The bundle is read one line at a time and each system is checked as soon as it has been read, so
+there is no limit on its size.
+
+--archive checks every bundle in a directory, like an archive of nightly captures from every site,
+using maxprocesses processes at the same time.  The report has the totals for the whole archive and
+for each check, a line for every bundle, and then the problems found in each bundle.
+
+If NumPy is installed, the vNICs of each system are checked together with NumPy arrays (see
+vectorize at the top of this script), which is faster for systems and archives with many vNICs.
+Without it they are checked one at a time, with the same results.
+
+Each check (but not --bundle or --archive) saves the changes to the state of every backing device
+and the problems found and cleared in a history in historydir.  The report then says how long each
+problem has been there, and has a note for every backing device that changed state more than
+flapcount times in the last flapwindow seconds.  --flapping N lists the backing devices that
+changed state more than N times in the last flapwindow seconds from the history, without asking
+the HMCs.  Changes older than historyretention seconds are removed from the history once a day.
+
+Reports are sent in the background to the sinks in notifysinks: email to smtphost, an mbox file
+(notifyfile) and a webhook (notifyurl), so a mail server that is down does not slow the checks.
+A failed send is tried again with a growing wait (notifybackoff up to notifybackoffmax seconds)
+over one reused connection, and reports waiting for the same sink are sent together as one.  At
+the end of a run the script waits up to notifywait seconds, and reports still not sent are kept in
+spooldir and sent by the next run.  With --daemon new reports wait notifybatch seconds for others.
 """
 
-  command = basecmd + ' --header -F ' + '%'.join(namelist);
-  readdata=''
-
-  process = subprocess.run(["ssh",hmc,"-o","BatchMode=yes",command],stdout=subprocess.PIPE,stderr=subprocess.PIPE,encoding="utf-8", universal_newlines=True) 
-  if (process.returncode != 0):
-    print("Error processing SSH Command: "+command)
-    print(process.stderr)
-    return([])
-  readdata = process.stdout
-  if ("No results were found." in readdata):
-    return([])
-  
-  cmdResp = readdata.split("\n")
-  
-  hdr = cmdResp.pop(0).split('%')
-  
-  rtndata = []
-  
-  for line in cmdResp:
-    mydict = dict()
-    d=line.split("%")
-    if (len(d) == len(hdr)) :
-      for i in range(len(d)):
-        mydict[hdr[i]]=d[i]
-      rtndata.append(mydict)
-    
-  return rtndata
+parser = argparse.ArgumentParser(description=description)
+parser.add_argument("--refresh",help="Ignore the cached HMC data and read everything from the HMC again",action="store_true")
+modegroup = parser.add_mutually_exclusive_group()
+modegroup.add_argument("--daemon",help="Keep running, poll the vNICs on every system and only report changes",action="store_true")
+modegroup.add_argument("--offline",help="Print the command that collects an offline bundle on an HMC, for use with --bundle",action="store_true")
+modegroup.add_argument("--archive",help="Check every offline bundle in this directory and the directories below it, and report on all of them together")
+modegroup.add_argument("--flapping",help="List the backing devices in the history that changed state more than this many times in the last flapwindow seconds",type=int)
+modegroup.add_argument("--bundle",help="Check the output of the --offline command instead of asking the HMCs (can be gzip compressed, - for stdin) - can be repeated for many HMCs",action="append")
+parser.add_argument("--metrics-json",help="Write a JSON summary of the HMC command timings and system health to this file",default=metricsjson)
+parser.add_argument("--metrics-prom",help="Write the metrics to this file for the Prometheus node_exporter textfile collector",default=metricsprom)
+parser.add_argument("--hmc",help="HMC to check instead of the hmcs list at the top of this script [username@]hmcname - can be repeated or a comma seperated list",action="append")
+parser.add_argument("--ssh",help="Command to run instead of ssh, for example 'python3 hmc-sim.py --systems=20' to test without an HMC",default="ssh")
+parser.add_argument("--transport",help="How to ask the HMCs: ssh (the HMC command line) or rest (the HMC REST API)",choices=['ssh','rest'],default=hmctransport)
+parser.add_argument("--rest-url",help="Address of the HMC REST API, {hmc} is replaced by the HMC host name (default "+resturl+")",default=resturl)
+
+args = parser.parse_args()
+
+if (args.hmc != None):
+  hmcs = [name for arg in args.hmc for name in arg.split(',') if name != '']
+
+hmclib.setup(sshprogram=shlex.split(args.ssh), transport=args.transport, resturl=args.rest_url, cmdtimeout=cmdtimeout,
+              hmcdeadline=hmcdeadline, maxperhmc=maxperhmc, sshpersist=sshpersist, sshretries=sshretries,
+              sshbackoff=sshbackoff, restpasswordfile=restpasswordfile, restcafile=restcafile, restverify=restverify,
+              restworkers=restworkers, cachemetrics=True, healthmetrics=True)
+
+# Code from here on:
+
+def collect_system(hmc, sysname):
+  """Collects the vNIC data for one managed system
+
+  Runs the HMC query needed to check the vNICs on a managed system.  This is run on the worker
+  pool, so many systems are collected at the same time.  The SRIOV physical port data is only
+  needed to describe ports that are not operational, so port_lookup is only called (here, on the
+  pool, rather than later by the checks one system at a time) if a backing device is not operational.
+
+  Parameter 1 - the hmc host name
+  Parameter 2 - the managed system name
+
+  Returns the vniclist in the format returned by run_hmc_query
+  """
+
+  vniclist = run_hmc_query(hmc,f'lshwres -m {sysname} -r virtualio --rsubtype vnic',['lpar_name','lpar_id','slot_num','auto_priority_failover','backing_devices','backing_device_states'])
+  if any(bstate['status'] != 'Operational' for vnic in vniclist for bstate in backingstates(vnic['backing_device_states'])):
+    port_lookup(hmc, sysname)
+  return vniclist
+
+
+portlookups = dict() # (hmc, system name) to the port lookup dictionary built by port_lookup
+
+def port_lookup(hmc, sysname):
+  """returns the SRIOV physical port details for a managed system
+
+  The physical port data is only read (from the cache or the HMC) the first time it is needed for a
+  system, which is when the first backing device that is not operational is reported.  Healthy
+  systems never need it.  The result is kept for the rest of the run.
+
+  Parameter 1 - the hmc host name
+  Parameter 2 - the managed system name
+
+  Returns a lookup dictionary from adapterid-phys_port_id to the physical port details from lshwres sriov physport.
+   The dictionary is empty if the HMC could not be asked in time.
+  """
+
+  if (hmc, sysname) not in portlookups:
+    portfields = ['adapter_id','phys_port_id','phys_port_label','phys_port_sub_label','phys_port_loc']
+
+    # get all SRIOV physical port data for system in one call to the HMC
+    try:
+      allports = cached_hmc_queries(hmc,sysname,[
+        (f'lshwres -m {sysname} -r sriov --rsubtype physport --level eth',portfields,'physport'),
+        (f'lshwres -m {sysname} -r sriov --rsubtype physport --level ethc',portfields,'physport'),
+        (f'lshwres -m {sysname} -r sriov --rsubtype physport --level roce',portfields,'physport')])
+    except HmcError as e:
+      # the ports are then reported by adapter and port id
+      print(f"WARNING: unable to read the SRIOV physical ports of {sysname}: {e}")
+      allports = []
+
+    portlookup = dict()
+    for ports in allports:
+      for p in ports:
+        portlookup[p['adapter_id']+"-"+p['phys_port_id']]=p
+    portlookups[(hmc, sysname)] = portlookup
 
+  return portlookups[(hmc, sysname)]
+
+
+def cached_hmc_queries(hmc, sysname, queries):
+  """Runs query commands on HMC, reusing recent results from the on-disk cache
+
+  Each query has a cache type.  If that type has a time to live in cachettl, a result that was saved
+  in cachedir less than that many seconds ago is used instead of asking the HMC.  All of the
+  queries that do need to go to the HMC are sent together with run_hmc_queries, and their results
+  are saved for the next run, including empty ones ("No results were found."), but not failed ones.
+
+  Parameter 1 - the hmc host name where the commands should be run
+  Parameter 2 - the managed system name the queries are for, or None for HMC wide queries
+  Parameter 3 - a list of (basecmd, namelist, cachetype) tuples.  basecmd and namelist are the same as
+                 the run_hmc_query parameters, cachetype is a key of cachettl or None to never cache
+
+  Returns a list with one list of records per query, in the same order as the queries
+  """
+
+  rtndata = [None for q in queries]
+  fetch = [] # indexes of the queries that must be run on the HMC
+
+  for i, (basecmd, namelist, cachetype) in enumerate(queries):
+    if (cachedir is not None and cachetype in cachettl and not args.refresh):
+      rtndata[i] = cache_read(hmc, sysname, basecmd, namelist, cachettl[cachetype])
+    if (rtndata[i] is None):
+      fetch.append(i)
+    else:
+      record_command(hmc, basecmd, 0.0, {'rows': len(rtndata[i])}, cached=True)
+
+  if (len(fetch) > 0):
+    failed = set()
+    results = run_hmc_queries(hmc,[queries[i][:2] for i in fetch],failed)
+    for n, (i, rows) in enumerate(zip(fetch, results)):
+      rtndata[i] = rows
+      basecmd, namelist, cachetype = queries[i]
+      if (cachedir is not None and cachetype in cachettl and n not in failed):
+        cache_write(hmc, sysname, basecmd, namelist, rows)
 
-def structuredfield(data,namelist):
-  """extract a list of HMC structured fields
-  
-  This function extracts a list of dictionaries from an HMC structured field that contains a comma seperated list of slash delimited values.  WARNING: this
-  will not handle the crazy quoting on fileds like virtual_fc_adapters.
-  
-  Parameter 1 - the data to be parsed
-  Paramater 2 - An ordered list of the field names for the slash delimited values for each list item
-  
-  Example Call: backingstate = structuredfield(vnic['backing_device_states'],['sriov','sriov-logical-port-ID','active','status'])
-  
-  Example of  the format processed:
-    sriov/2701c001/1/Operational,sriov/27018001/0/Operational,sriov/27018002/0/NotOperational
-    
-  Example of output from that data:
-    [{'sriov': 'sriov', 'sriov-logical-port-ID': '2701c001', 'active': '1', 'status': 'Operational'}, {'sriov': 'sriov', 'sriov-logical-port-ID': '27018001', 'active': '0', 'status': 'Operational'}, {'sriov': 'sriov', 'sriov-logical-port-ID': '27018002', 'active': '0', 'status': 'NotOperational'}]
-    
-  """
-  
-  rtndata=[]
-  
-  for group in data.split(','):
-    mydict = dict()
-    d = group.split('/')
-    for i in range(max(len(d),len(namelist))):
-      mydict[namelist[i]]=d[i]
-    rtndata.append(mydict)
-    
   return rtndata
-  
-  
-def byprty(bdev):
-  """sort function to allow sorting of backing device dictionaries by failover-priority"""
-  
-  return bdev['failover-priority']
 
-#
-## Start of Mainline
-#
 
-email = io.StringIO() # String stream to collect output
-sendemail = False
-  
-# Create an email header
-toaddrout = ",".join(toaddrs);
-print(f"""From: <{sender}>
+def cache_file(hmc, sysname, basecmd, namelist):
+  """returns the cache file name for a query on a system on an HMC"""
+
+  key = "\0".join([hmc, str(sysname), basecmd] + list(namelist))
+  return os.path.join(cachedir, hashlib.sha1(key.encode("utf-8")).hexdigest() + ".json")
+
+
+def cache_read(hmc, sysname, basecmd, namelist, ttl):
+  """returns the cached records for a query if they are less than ttl seconds old, otherwise None"""
+
+  try:
+    with open(cache_file(hmc, sysname, basecmd, namelist), "r") as f:
+      entry = json.load(f)
+  except (OSError, ValueError):
+    return None
+
+  if (entry.get('time', 0) + ttl < time.time()):
+    return None
+
+  rowtype = hmc_row_type(entry['header'])
+  return [rowtype(row) for row in entry['rows']]
+
+
+def cache_write(hmc, sysname, basecmd, namelist, rows):
+  """saves the records for a query in the cache
+
+  The entry is written to a temporary file that is renamed into place, so a reader never sees a
+  partly written entry, even if two runs overlap.  The oldest entries are then removed until the
+  cache is no larger than cachemaxbytes.
+  """
+
+  entry = {'hmc': hmc, 'system': sysname, 'command': basecmd, 'time': time.time(),
+           'header': list(rows[0].fields) if len(rows) > 0 else list(namelist), 'rows': rows}
+
+  try:
+    os.makedirs(cachedir, exist_ok=True)
+    fd, tmpname = tempfile.mkstemp(dir=cachedir, suffix=".tmp")
+    with os.fdopen(fd, "w") as f:
+      json.dump(entry, f)
+    os.replace(tmpname, cache_file(hmc, sysname, basecmd, namelist))
+  except OSError as e:
+    print(f"WARNING: unable to save HMC data in cache directory {cachedir}: {e}")
+    return
+
+  with cachelock:
+    entries = []
+    total = 0
+    for name in os.listdir(cachedir):
+      try:
+        st = os.stat(os.path.join(cachedir, name))
+      except OSError:
+        continue
+      entries.append((st.st_mtime, st.st_size, name))
+      total += st.st_size
+    for mtime, size, name in sorted(entries):
+      if (total <= cachemaxbytes):
+        break
+      try:
+        os.remove(os.path.join(cachedir, name))
+      except OSError:
+        pass
+      total -= size
+
+cachelock = threading.Lock() # serializes the size checks of the cache directory
+
+
+def history_open():
+  """Locks the history store and loads its index
+
+  The history is an append-only log in historydir of the backing device state changes and the
+  problems found and cleared, with an index of the current state of every backing device and
+  vNIC, the time it changed to that state and its recent change times.  The index says how much of
+  the log it covers, so log entries from a run that stopped before it saved the index are read
+  again, and a lost index is rebuilt from the whole log.  The store is locked until history_close,
+  so runs that overlap take turns.
+
+  Returns the history, a dictionary with the 'index', the 'events' to add to the log, 'now' (the
+  time of this run) and the 'lock' file.  Returns None if historydir is None or can not be used.
+  """
+
+  if (historydir is None):
+    return None
+
+  try:
+    os.makedirs(historydir, exist_ok=True)
+    lock = open(os.path.join(historydir, "lock"), "a")
+    fcntl.flock(lock, fcntl.LOCK_EX)
+  except OSError as e:
+    print(f"WARNING: unable to use history directory {historydir}: {e}")
+    return None
+
+  logname = os.path.join(historydir, "history.log")
+  try:
+    with open(os.path.join(historydir, "index.json"), "r") as f:
+      index = json.load(f)
+  except (OSError, ValueError):
+    index = None
+  try:
+    logsize = os.path.getsize(logname)
+  except OSError:
+    logsize = 0
+
+  history = {'index': index, 'events': [], 'now': time.time(), 'lock': lock, 'dirty': False}
+  if (index is None or index.get('version') != 1 or index['logsize'] > logsize):
+    history['index'] = {'version': 1, 'logsize': 0, 'compacted': history['now'], 'systems': dict()}
+  if (history['index']['logsize'] < logsize):
+    with open(logname, "rb") as f:
+      f.seek(history['index']['logsize'])
+      for line in f:
+        try:
+          history_apply(history['index'], json.loads(line))
+        except (ValueError, IndexError, TypeError):
+          # a line that was only partly written when a run was stopped
+          pass
+    history['index']['logsize'] = logsize
+    history['dirty'] = True
+  return history
+
+
+def history_apply(index, event):
+  """updates the history index with one log entry
+
+  A log entry is a list of [time, kind, hmc, system name, key, values...], where kind is one of:
+    state   - the key is lpar_id, slot_num and sriov-logical-port-ID (tab seperated) of a backing
+               device and the values are its active and status from backing_device_states
+    removed - the backing device with the key is gone
+    found   - the key is lpar_id and slot_num of a vNIC and the value is a new problem with it
+    cleared - the problem (the value) on the vNIC with the key is gone
+  """
+
+  t, kind, hmc, sysname, key = event[:5]
+  system = index['systems'].setdefault(hmc+"\t"+sysname, {'devices': dict(), 'findings': dict()})
+  if (kind == 'state'):
+    entry = system['devices'].get(key)
+    if (entry is None):
+      # [active, status, time it changed to this state, times of the recent changes]
+      system['devices'][key] = [event[5], event[6], t, []]
+    elif (entry[0] != event[5] or entry[1] != event[6]):
+      # the flap checks only count the changes in the last flapwindow seconds, so the index keeps no
+      # more than that.  The log has all of them, so after a larger flapwindow delete index.json to rebuild it
+      entry[3] = [c for c in entry[3] if c >= t - flapwindow] + [t]
+      entry[0:3] = [event[5], event[6], t]
+  elif (kind == 'removed'):
+    system['devices'].pop(key, None)
+  elif (kind == 'found'):
+    system['findings'].setdefault(key, dict()).setdefault(event[5], t)
+  elif (kind == 'cleared'):
+    problems = system['findings'].get(key, dict())
+    problems.pop(event[5], None)
+    if (len(problems) == 0):
+      system['findings'].pop(key, None)
+
+
+def history_event(history, event):
+  """adds an entry to the history log and updates the index with it"""
+
+  history['events'].append(event)
+  history_apply(history['index'], event)
+  history['dirty'] = True
+
+
+def history_record(history, hmc, sysname, vniclist, findings):
+  """Saves the backing device states and the problems of a managed system in the history
+
+  Only the changes since the last run are added to the log: backing devices that are new, changed
+  state or are gone, and problems that are new or cleared.  An empty vniclist is most likely a
+  failed query, so it is not saved.
+
+  Parameter 1 - the history from history_open, or None
+  Parameter 2 - the hmc host name
+  Parameter 3 - the managed system name
+  Parameter 4 - the vniclist from collect_system
+  Parameter 5 - the findings for the vniclist from check_system
+
+  Returns a dictionary from the vNIC description in findings to a tuple of (a dictionary from each
+   problem to the time it was first found, a list of notes about its flapping backing devices) for
+   the report, for the vNICs that have problems
+  """
+
+  if (history is None or len(vniclist) == 0):
+    return dict()
+
+  now = history['now']
+  system = history['index']['systems'].setdefault(hmc+"\t"+sysname, {'devices': dict(), 'findings': dict()})
+  seen = set()
+  seenvnics = set()
+  context = dict()
+
+  for vnic in vniclist:
+    vnickey = vnic['lpar_id']+"\t"+vnic['slot_num']
+    seenvnics.add(vnickey)
+    logports = []
+    for bstate in backingstates(vnic['backing_device_states']):
+      key = vnickey+"\t"+bstate['sriov-logical-port-ID']
+      seen.add(key)
+      logports.append((bstate['sriov-logical-port-ID'], key))
+      entry = system['devices'].get(key)
+      if (entry is None or entry[0] != bstate['active'] or entry[1] != bstate['status']):
+        history_event(history, [now, 'state', hmc, sysname, key, bstate['active'], bstate['status']])
+
+    vnicdesc = vnic_description(vnic)
+    problems = findings.get(vnicdesc, [])
+    known = system['findings'].get(vnickey, dict())
+    for problem in problems:
+      if (problem not in known):
+        history_event(history, [now, 'found', hmc, sysname, vnickey, problem])
+    for problem in [p for p in known if p not in problems]:
+      history_event(history, [now, 'cleared', hmc, sysname, vnickey, problem])
+
+    if (len(problems) > 0):
+      notes = []
+      for logport, key in logports:
+        active, status, since, changes = system['devices'][key]
+        flaps = len(changes) - bisect.bisect_left(changes, now - flapwindow)
+        if (flaps > flapcount):
+          notes.append(f"logical port {logport} changed state {flaps} times in the last {duration_text(flapwindow)}, "
+                       f"it has been {status}{' and active' if active == '1' else ''} for {duration_text(now - since)}")
+      context[vnicdesc] = (dict(system['findings'].get(vnickey, dict())), notes)
+
+  for key in [key for key in system['devices'] if key not in seen]:
+    history_event(history, [now, 'removed', hmc, sysname, key])
+  for vnickey, problems in list(system['findings'].items()):
+    if (vnickey not in seenvnics):
+      for problem in list(problems):
+        history_event(history, [now, 'cleared', hmc, sysname, vnickey, problem])
+
+  return context
+
+
+def history_close(history):
+  """adds the new entries to the history log, saves the index and unlocks the store
+
+  The log is compacted with history_compact once a day.
+  """
+
+  if (history is None):
+    return
+
+  index = history['index']
+  logname = os.path.join(historydir, "history.log")
+  try:
+    if (len(history['events']) > 0):
+      with open(logname, "a") as f:
+        # finish a line that was only partly written when a run was stopped
+        if (f.tell() > 0):
+          with open(logname, "rb") as check:
+            check.seek(-1, os.SEEK_END)
+            if (check.read(1) != b"\n"):
+              f.write("\n")
+        for event in history['events']:
+          f.write(json.dumps(event, separators=(',', ':'))+"\n")
+      index['logsize'] = os.path.getsize(logname)
+      history['events'] = []
+
+    if (history['now'] - index['compacted'] >= 86400):
+      history_compact(history)
+
+    if (history['dirty']):
+      fd, tmpname = tempfile.mkstemp(dir=historydir, suffix=".tmp")
+      with os.fdopen(fd, "w") as f:
+        json.dump(index, f, separators=(',', ':'))
+      os.replace(tmpname, os.path.join(historydir, "index.json"))
+  except OSError as e:
+    print(f"WARNING: unable to save the history in {historydir}: {e}")
+  finally:
+    history['lock'].close()
+
+
+def history_compact(history):
+  """removes the log entries that are older than historyretention seconds
+
+  The log is read twice, one line at a time.  The entries before the cutoff are applied to an
+  empty index, and the state they leave (with the time each state started) is written as the first
+  entries of the new log, followed by the entries after the cutoff.  The new log replaces the old
+  one, so the index rebuilt from it is the same as the index being kept.
+  """
+
+  index = history['index']
+  cutoff = history['now'] - historyretention
+  logname = os.path.join(historydir, "history.log")
+  baseline = {'systems': dict()}
+
+  with open(logname, "r") as old:
+    for line in old:
+      try:
+        event = json.loads(line)
+        if (event[0] < cutoff):
+          history_apply(baseline, event)
+      except (ValueError, IndexError, TypeError):
+        pass
+
+  fd, tmpname = tempfile.mkstemp(dir=historydir, suffix=".tmp")
+  with os.fdopen(fd, "w") as new, open(logname, "r") as old:
+    for syskey, system in baseline['systems'].items():
+      hmc, sysname = syskey.split("\t")
+      for key, (active, status, since, changes) in system['devices'].items():
+        new.write(json.dumps([since, 'state', hmc, sysname, key, active, status], separators=(',', ':'))+"\n")
+      for vnickey, problems in system['findings'].items():
+        for problem, since in problems.items():
+          new.write(json.dumps([since, 'found', hmc, sysname, vnickey, problem], separators=(',', ':'))+"\n")
+    for line in old:
+      try:
+        if (json.loads(line)[0] >= cutoff):
+          new.write(line)
+      except (ValueError, IndexError, TypeError):
+        pass
+  os.replace(tmpname, logname)
+
+  index['logsize'] = os.path.getsize(logname)
+  index['compacted'] = history['now']
+  for system in index['systems'].values():
+    for entry in system['devices'].values():
+      entry[3] = [c for c in entry[3] if c >= history['now'] - flapwindow]
+  history['dirty'] = True
+
+
+def duration_text(seconds):
+  """returns a length of time for the report, like 3d 4h, 2h 5m, 45m or 30s"""
+
+  seconds = int(seconds)
+  if (seconds >= 86400):
+    return f"{seconds // 86400}d {seconds % 86400 // 3600}h"
+  if (seconds >= 3600):
+    return f"{seconds // 3600}h {seconds % 3600 // 60}m"
+  if (seconds >= 60):
+    return f"{seconds // 60}m"
+  return f"{seconds}s"
+
+
+vnicrules = ['priority-order', 'duplicate-priority', 'vios-duplicate', 'not-operational', 'min-operational'] # the checks made by check_vnic, for the problem counts by check
+
+def check_vnic(hmc, sysname, vnic, health=None):
+  """Checks the backing devices of one vNIC
+
+  Checks that the active backing device is the one with the lowest failover priority, that no
+  failover priority is used twice, that no VIOS has more than one backing device for the vNIC, that
+  every backing device is operational and that there are at least minopercount operational
+  backing devices.
+
+  Parameter 1 - the hmc host name
+  Parameter 2 - the managed system name
+  Parameter 3 - the vNIC record from lshwres -r virtualio --rsubtype vnic
+  Parameter 4 - a dictionary to add the 'backingdevices' and 'operational' counts of the vNIC, and its
+                 problem counts by check (a dictionary in 'rules' with the vnicrules names), to or None
+
+  Returns a list of problem descriptions, empty if the vNIC has no problems
+  """
+
+  backinglist = backingdevices(vnic['backing_devices'])
+  backingstate = backingstates(vnic['backing_device_states'])
+
+  # make a lookup table by sriov-logical-port-id
+  statlookup = dict()
+  for bstate in backingstate:
+    statlookup[bstate['sriov-logical-port-ID']]=bstate
+
+  lastprty = None
+  prtyerror = False
+  dupprty = set() # Failover priorities that are duplicated
+  viosdup = [] # VIOS with multiple backing devices for vNIC
+  notoper = [] # list of non-operational backing devices
+  opercount = 0 # how many operational backing devices
+  viosset = set() # used to track which VIOS have been seen already
+  for bdev in sorted(backinglist,key=byprty):
+    bstate = statlookup[bdev['sriov-logical-port-ID']]
+    if (lastprty is None and bstate['active'] != '1'):
+      prtyerror = True
+    if (lastprty == bdev['failover-priority']):
+      dupprty.add(bdev['failover-priority'])
+    lastprty=bdev['failover-priority']
+    if bdev['vios-lpar-name'] in viosset:
+      viosdup.append(bdev['vios-lpar-name'])
+    viosset.add(bdev['vios-lpar-name'])
+    if bstate['status'] == 'Operational':
+      opercount += 1
+    else:
+      notoper.append(bdev['sriov-adapter-ID']+"-"+bdev['sriov-physical-port-ID'])
+
+  if (health is not None):
+    health['backingdevices'] += len(backinglist)
+    health['operational'] += opercount
+
+  return vnic_problems(hmc, sysname, prtyerror, dupprty, viosdup, notoper, opercount, health)
+
+
+def vnic_problems(hmc, sysname, prtyerror, dupprty, viosdup, notoper, opercount, health=None):
+  """returns the problem descriptions for the results of the checks on one vNIC
+
+  This is shared by check_vnic and check_vnics_vectorized, so both describe problems the same way.
+
+  Parameter 1 - the hmc host name
+  Parameter 2 - the managed system name
+  Parameter 3 - True if the active backing device is not the one with the lowest failover priority
+  Parameter 4 - the set of failover priorities that are used more than once
+  Parameter 5 - the list of VIOS names that have more than one backing device, once for each extra device
+  Parameter 6 - the list of adapterid-phys_port_id of the backing devices that are not operational, in priority order
+  Parameter 7 - the number of operational backing devices
+  Parameter 8 - a dictionary with the problem counts by check in 'rules' to add to, or None
+
+  Returns a list of problem descriptions, empty if the vNIC has no problems
+  """
+
+  problems = []
+  if (prtyerror):
+    problems.append("Lowest priority interface is not the active interface")
+  for dup in sorted(dupprty):
+    problems.append("failover priority "+dup+" is duplicated")
+  for v in viosdup:
+    problems.append("Multiple backing devices on VIOS "+v)
+  for dev in notoper:
+    port = port_lookup(hmc,sysname).get(dev)
+    portloc = port['phys_port_loc'] if port is not None else "adapter-port "+dev
+    problems.append("SRIOV physical port "+portloc+" is not operational")
+  if (opercount < minopercount):
+    problems.append("Less than "+str(minopercount)+" operational backing devices ("+str(opercount)+")")
+
+  if (health is not None):
+    health['rules']['priority-order'] += int(prtyerror)
+    health['rules']['duplicate-priority'] += len(dupprty)
+    health['rules']['vios-duplicate'] += len(viosdup)
+    health['rules']['not-operational'] += len(notoper)
+    health['rules']['min-operational'] += int(opercount < minopercount)
+
+  return problems
+
+
+def backing_table(vniclist):
+  """Builds a columnar table of the backing devices of all of the vNICs of a managed system
+
+  The backing_devices and backing_device_states fields of all of the vNICs are joined and split
+  into values in one go, and each column is sliced out of the values by position, so no Python code
+  is run for each backing device.  This only works for the usual layout, where every item has all
+  of its values, nothing is quoted, every failover priority is a number and the states are in the
+  same order as the backing devices.
+
+  Parameter 1 - the vniclist from collect_system
+
+  Returns a dictionary of NumPy arrays, one element per backing device in vniclist and backing_devices order:
+    vnic     - the index in vniclist of the vNIC of the backing device
+    priority - the failover priority
+    active   - True for the active backing devices
+    status   - 0 for Operational and a number for each other status
+    vios     - a number for each VIOS name
+   and 'values', the list of the backing_devices values with len(backingdevicefields) values per device.
+   Returns None if the fields are not in the usual layout, so the vNICs must be checked with check_vnic.
+  """
+
+  devicedata = [vnic['backing_devices'] for vnic in vniclist]
+  statedata = [vnic['backing_device_states'] for vnic in vniclist]
+  counts = [0 if data in ('', 'none', 'null') else data.count(',') + 1 for data in devicedata]
+  statecounts = [0 if data in ('', 'none', 'null') else data.count(',') + 1 for data in statedata]
+  if (counts != statecounts):
+    return None
+
+  devicetext = ','.join(data for data, count in zip(devicedata, counts) if count > 0)
+  statetext = ','.join(data for data, count in zip(statedata, counts) if count > 0)
+  if ('"' in devicetext or '"' in statetext):
+    return None
+  values = devicetext.replace(',', '/').split('/') if devicetext != '' else []
+  states = statetext.replace(',', '/').split('/') if statetext != '' else []
+
+  width = len(backingdevicefields)
+  statewidth = len(backingstatefields)
+  if (len(values) != sum(counts) * width or len(states) != sum(counts) * statewidth):
+    return None
+  def column(name):
+    return values[backingdevicefields.index(name)::width]
+  def statecolumn(name):
+    return states[backingstatefields.index(name)::statewidth]
+  if (column('sriov-logical-port-ID') != statecolumn('sriov-logical-port-ID')):
+    return None
+  priorities = column('failover-priority')
+  if not all(prty.isdigit() for prty in priorities):
+    return None
+
+  status = numpy.array(statecolumn('status'), dtype=str)
+  statuscodes = numpy.unique(status, return_inverse=True)[1].reshape(-1) + 1
+  statuscodes[status == 'Operational'] = 0
+  return {'vnic': numpy.repeat(numpy.arange(len(vniclist)), counts),
+          'priority': numpy.array(priorities, dtype=str).astype(numpy.int64),
+          'active': numpy.array(statecolumn('active'), dtype=str) == '1',
+          'status': statuscodes,
+          'vios': numpy.unique(numpy.array(column('vios-lpar-name'), dtype=str), return_inverse=True)[1].reshape(-1),
+          'values': values}
+
+
+def check_vnics_vectorized(hmc, sysname, vniclist, health):
+  """Checks all of the vNICs of a managed system together with NumPy
+
+  The checks of check_vnic are run on the backing_table of the system as grouped array operations
+  over all of the backing devices at once, and only the vNICs with problems are looked at one at a
+  time to describe them.  The findings are the same as from check_vnic.
+
+  Parameter 1 - the hmc host name
+  Parameter 2 - the managed system name
+  Parameter 3 - the vniclist from collect_system
+  Parameter 4 - a dictionary to add the counts of the backing devices to, like the check_vnic health parameter
+
+  Returns a list with the list of problems (from vnic_problems) of each vNIC, in vniclist order, or
+   None if the backing devices are not in the layout backing_table needs
+  """
+
+  table = backing_table(vniclist)
+  if (table is None):
+    return None
+  count = len(table['vnic'])
+
+  # sort by vNIC and then by failover priority.  lexsort is stable, so devices with the same
+  # priority stay in backing_devices order like they do with sorted in check_vnic
+  order = numpy.lexsort((table['priority'], table['vnic']))
+  vnic = table['vnic'][order]
+  priority = table['priority'][order]
+  active = table['active'][order]
+  operational = table['status'][order] == 0
+  vios = table['vios'][order]
+
+  first = numpy.ones(count, dtype=bool) # the lowest priority device of each vNIC
+  first[1:] = vnic[1:] != vnic[:-1]
+  prtyerror = first & ~active
+  dupprty = numpy.zeros(count, dtype=bool) # a device with the same priority as the one before it
+  dupprty[1:] = ~first[1:] & (priority[1:] == priority[:-1])
+
+  # a device is a VIOS duplicate when a lower priority device of the same vNIC is on the same VIOS
+  byvios = numpy.lexsort((numpy.arange(count), vios, vnic))
+  firstonvios = numpy.ones(count, dtype=bool)
+  firstonvios[1:] = (vnic[byvios][1:] != vnic[byvios][:-1]) | (vios[byvios][1:] != vios[byvios][:-1])
+  viosdup = numpy.zeros(count, dtype=bool)
+  viosdup[byvios[~firstonvios]] = True
+
+  opercount = numpy.bincount(vnic, weights=operational, minlength=len(vniclist)).astype(numpy.int64)
+  health['backingdevices'] += count
+  health['operational'] += int(operational.sum())
+
+  # only the devices with a problem are looked at one at a time
+  flagged = dict() # vniclist index to the sorted positions of its devices with a problem
+  for i in numpy.nonzero(prtyerror | dupprty | viosdup | ~operational)[0].tolist():
+    flagged.setdefault(int(vnic[i]), []).append(i)
+  for n in numpy.nonzero(opercount < minopercount)[0].tolist():
+    flagged.setdefault(n, [])
+
+  width = len(backingdevicefields)
+  problemlists = [[] for vnic in vniclist]
+  for n, positions in flagged.items():
+    devices = [(i, dict(zip(backingdevicefields, table['values'][order[i]*width:(order[i]+1)*width]))) for i in positions]
+    problemlists[n] = vnic_problems(hmc, sysname,
+                                    any(prtyerror[i] for i, bdev in devices),
+                                    set(bdev['failover-priority'] for i, bdev in devices if dupprty[i]),
+                                    [bdev['vios-lpar-name'] for i, bdev in devices if viosdup[i]],
+                                    [bdev['sriov-adapter-ID']+"-"+bdev['sriov-physical-port-ID'] for i, bdev in devices if not operational[i]],
+                                    int(opercount[n]), health)
+  return problemlists
+
+
+def check_system(hmc, sysname, vniclist):
+  """Checks all of the vNICs of a managed system
+
+  Parameter 1 - the hmc host name
+  Parameter 2 - the managed system name
+  Parameter 3 - the vniclist from collect_system
+
+  Returns a dictionary, in vniclist order, from the vNIC description to the list of problems for
+   every vNIC that has problems.  The health counts of the system are saved with record_health.
+  """
+
+  findings = dict()
+  health = {'vnics': len(vniclist), 'backingdevices': 0, 'operational': 0, 'vnicproblems': 0, 'problems': 0,
+            'rules': dict.fromkeys(vnicrules, 0)}
+  problemlists = None
+  if (vectorize and numpy is not None):
+    problemlists = check_vnics_vectorized(hmc, sysname, vniclist, health)
+  if (problemlists is None):
+    problemlists = [check_vnic(hmc, sysname, vnic, health) for vnic in vniclist]
+
+  for vnic, problems in zip(vniclist, problemlists):
+    if (len(problems) > 0):
+      findings[vnic_description(vnic)] = problems
+      health['vnicproblems'] += 1
+      health['problems'] += len(problems)
+
+  record_health(hmc, sysname, health)
+  return findings
+
+
+def vnic_description(vnic):
+  """returns the description of a vNIC used in the findings from check_system"""
+
+  return "vNIC on LPAR "+vnic['lpar_name']+"(id "+vnic['lpar_id']+") Slot "+vnic['slot_num']
+
+
+def record_health(hmc, sysname, health):
+  """saves the health counts of a system from check_system for the metrics, or None if it was not checked
+
+  A system that was not checked keeps the counts from its last check.
+  """
+
+  with metricslock:
+    entry = metrics['systems'].setdefault((hmc, sysname), dict())
+    entry['checked'] = int(health is not None)
+    entry.update(health or dict())
+
+
+def system_header(sys):
+  """returns the report heading line for a managed system record from lssyscfg -r sys"""
+
+  return f"System: {sys['name']}  Model: {sys['type_model']}  S/N: {sys['serial_num']}"
+
+
+def print_findings(sys, findings, email, context=dict(), now=None):
+  """adds the problems found on a managed system by check_system to the report
+
+  With the context from history_record, each problem that was found by an earlier run has how
+  long it has been there, and the notes about flapping backing devices are added after the problems.
+  """
+
+  print(system_header(sys),file=email)
+  for vnicdesc, problems in findings.items():
+    since, notes = context.get(vnicdesc, (dict(), []))
+    print("Problems with "+vnicdesc, file=email)
+    for problem in problems:
+      if (since.get(problem, now) != now):
+        print("   - "+problem+" (for "+duration_text(now - since[problem])+")", file=email)
+      else:
+        print("   - "+problem, file=email)
+    for note in notes:
+      print("   * "+note, file=email)
+    print(file=email)
+
+
+def new_report(subject):
+  """returns a string stream for a report email with the email header already written"""
+
+  email = io.StringIO()
+  toaddrout = ",".join(toaddrs);
+  print(f"""From: <{sender}>
 To: {toaddrout}
-Subject: vNIC Status
+Subject: {subject}
 
 """, file=email);
+  return email
 
 
-for hmcname in hmcs:
-
-  syslist = run_hmc_query(hmcname,'lssyscfg -r sys',['name','type_model','serial_num','state'])
-  
-  for sys in syslist:
-    if (sys['state'] != "Operating"):
-      iter
-      
-    sysname = sys['name']
-    
-    syshdr = f"System: {sys['name']}  Model: {sys['type_model']}  S/N: {sys['serial_num']}"
-  
-    # these will be parameters
-    vniclist = run_hmc_query(hmcname,f'lshwres -m {sysname} -r virtualio --rsubtype vnic',['lpar_name','lpar_id','slot_num','auto_priority_failover','backing_devices','backing_device_states'])
-    
-    
-    # get all SRIOV physical port data for system
-    allports = run_hmc_query(hmcname,f'lshwres -m {sysname} -r sriov --rsubtype physport --level eth',['adapter_id','phys_port_id','phys_port_label','phys_port_sub_label','phys_port_loc'])
-    allports.extend(run_hmc_query(hmcname,f'lshwres -m {sysname} -r sriov --rsubtype physport --level ethc',['adapter_id','phys_port_id','phys_port_label','phys_port_sub_label','phys_port_loc']))
-    allports.extend(run_hmc_query(hmcname,f'lshwres -m {sysname} -r sriov --rsubtype physport --level roce',['adapter_id','phys_port_id','phys_port_label','phys_port_sub_label','phys_port_loc']))
-    
-    # create a lookup dictionary from adapterid-phys_port_id to the physical port details from lshwres sriov physport
-    portlookup = dict()
-    for p in allports:
-      portlookup[p['adapter_id']+"-"+p['phys_port_id']]=p
-    
-    for vnic in vniclist:
-      backinglist = structuredfield(vnic['backing_devices'],['sriov','vios-lpar-name','vios-lpar-ID','sriov-adapter-ID','sriov-physical-port-ID','sriov-logical-port-ID',
-      'current-capacity','desired-capacity','failover-priority','current-max-capacity','desired-max-capacity'])
-      backingstate = structuredfield(vnic['backing_device_states'],['sriov','sriov-logical-port-ID','active','status'])
-    
-      # make a lookup table by sriov-logical-port-id
-      statlookup = dict()
-      for bstate in backingstate:
-        statlookup[bstate['sriov-logical-port-ID']]=bstate
-    
-      lastprty = '00'
-      prtyerror = False
-      dupprty = set() # Failover priorities that are duplicated
-      viosdup = [] # VIOS with multiple backing devices for vNIC
-      notoper = [] # list of non-operational backing devices
-      opercount = 0 # how many operational backing devices
-      viosset = set() # used to track which VIOS have been seen already
-      for bdev in sorted(backinglist,key=byprty):
-        bstate = statlookup[bdev['sriov-logical-port-ID']]
-        bdev['state']=bstate
-        if (lastprty == '00' and bstate['active'] != '1'):
-         prtyerror = True
-        if (lastprty == bdev['failover-priority']):
-          dupprty.add(bdev['failover-priority'])
-        lastprty=bdev['failover-priority']
-        if bdev['vios-lpar-name'] in viosset:
-          viosdup.append(bdev['vios-lpar-name'])
-        viosset.add(bdev['vios-lpar-name'])
-        if bstate['status'] == 'Operational':
-          opercount += 1
-        else:
-          notoper.append(bdev['sriov-adapter-ID']+"-"+bdev['sriov-physical-port-ID'])
-    
-      # Generate email contents for errors in this vNIC      
-      if (prtyerror or len(dupprty) > 0 or viosdup > 0 or notoper > 0 or opercount < minopercount):
-        sendemail = True
-        if (syshdr is not None):
-          print(syshdr,file=email)
-          syshdr = None
-        print("Problems with vNIC on LPAR "+vnic['lpar_name']+"(id "+vnic['lpar_id']+") Slot "+vnic['slot_num'], file=email)
-        if (prtyerror):
-          print("   - Lowest priority interface is not the active interface", file=email)
-        for dup in dupprty:
-          print("   - failover priority "+dup+" is duplicated", file=email)
-        for v in viosdup:
-          print("   - Multiple backing devices on VIOS "+v, file=email)
-        for dev in notoper:
-          print("   - SRIOV physical port "+portlookup[dev]['phys_port_loc']+" is not operational",file=email)
-        if (opercount < minopercount): 
-          print("   - Less than "+str(minopercount)+" operational backing devices ("+str(opercount)+")", file=email)
-        print(file=email)
-  
-  
-# Print the result or send an email
-
-if smtphost is None:
-  print(email.getvalue())
-  
-elif sendemail:
-  smtpobj = None
-  for trynum in range(5):
+def send_report(email, sendemail):
+  """Prints the report or queues it for the notification sinks
+
+  The report is written to the spool before it is queued, and sent by the notify_worker thread, so
+  a mail server that can not be reached does not hold up the checks.
+
+  Parameter 1 - the string stream from new_report with the report contents
+  Parameter 2 - True if the report has problems in it and should be sent
+  """
+
+  if smtphost is None:
+    print(email.getvalue(), flush=True)
+
+  if (sendemail):
+    headers, body = email.getvalue().split("\n\n", 1)
+    subject = [h[9:] for h in headers.splitlines() if h.startswith("Subject: ")][0]
+    message = {'time': time.time(), 'subject': subject, 'body': body.lstrip("\n")}
+    for sink in notify_sinks():
+      notifyqueue.put((sink, spool_message(sink, message), message))
+  # the reports left in the spool by earlier runs are sent with this one
+  notify_start()
+
+  email.close()
+
+
+notifyqueue = queue.Queue() # (sink, spool file, message) of the reports for notify_worker, None to stop it
+notifythread = None # the notify_worker thread, started by notify_start
+notifybatchwait = 0 # seconds notify_worker waits for more reports to send with a new one
+
+def notify_sinks():
+  """returns the names of the notification sinks in notifysinks that are set up"""
+
+  configured = {'smtp': smtphost, 'file': notifyfile, 'webhook': notifyurl}
+  return [sink for sink in notifysinks if configured.get(sink) is not None]
+
+
+def notify_start(batchwait=0):
+  """Starts the notify_worker thread, if it is not running, and queues the reports left in the spool
+
+  Parameter 1 - seconds to wait for more reports to send together with a new one, 0 to send it
+                 right away (only used when the thread is started)
+  """
+
+  global notifythread, notifybatchwait
+
+  if (notifythread is not None or len(notify_sinks()) == 0):
+    return
+  notifybatchwait = batchwait
+  for sink, spoolfile, message in spool_orphans():
+    notifyqueue.put((sink, spoolfile, message))
+  notifythread = threading.Thread(target=notify_worker, name="notify", daemon=True)
+  notifythread.start()
+  atexit.register(notify_close)
+
+
+def notify_close():
+  """Asks notify_worker to send what it has and stop, and waits up to notifywait seconds for it
+
+  Reports that were not sent stay in the spool for the next run.
+  """
+
+  notifyqueue.put(None)
+  notifythread.join(notifywait)
+  left = len(spool_files(mine=True))
+  if (left > 0):
+    print(f"WARNING: {left} notifications could not be sent, they are kept in {spooldir} for the next run", flush=True)
+
+
+def notify_worker():
+  """Sends the queued reports to their sinks until notify_close asks it to stop
+
+  All of the reports waiting for a sink are sent together as one (see coalesce_messages).  When a
+  sink fails its reports are kept and tried again after notifybackoff seconds, doubled after every
+  failure up to notifybackoffmax seconds, while new reports for it wait with them.  Once asked to
+  stop, a sink is only tried again if that is due within notifywait seconds.
+  """
+
+  pending = {sink: [] for sink in notify_sinks()} # sink to the list of (spool file, message) waiting for it
+  retry = {sink: [0, notifybackoff] for sink in pending} # sink to [time of the next try, seconds to wait after a failure]
+  deadline = None
+  connection = dict()
+
+  while True:
+    now = time.time()
+    due = [retry[sink][0] for sink in pending if len(pending[sink]) > 0]
+    if (deadline is not None):
+      due = [t for t in due if t <= deadline]
+      if (len(due) == 0):
+        break
+    try:
+      items = [notifyqueue.get(timeout=max(min(due) - now, 0) if len(due) > 0 else None)]
+    except queue.Empty:
+      items = []
+    if (len(items) > 0 and items[0] is not None and notifybatchwait > 0 and deadline is None):
+      sleep(notifybatchwait)
+    with contextlib.suppress(queue.Empty):
+      while True:
+        items.append(notifyqueue.get_nowait())
+    for item in items:
+      if (item is None):
+        deadline = time.time() + notifywait
+      else:
+        pending[item[0]].append(item[1:])
+
+    for sink, messages in pending.items():
+      if (len(messages) == 0 or retry[sink][0] > time.time()):
+        continue
+      try:
+        notifiers[sink](coalesce_messages([m for f, m in messages]), connection)
+      except Exception as e:
+        print(f"WARNING: unable to send the report to {sink}, trying again in {retry[sink][1]} seconds: {e}", flush=True)
+        retry[sink] = [time.time() + retry[sink][1], min(retry[sink][1] * 2, notifybackoffmax)]
+        continue
+      for spoolfile, message in messages:
+        spool_remove(spoolfile)
+      pending[sink] = []
+      retry[sink] = [0, notifybackoff]
+
+  if (connection.get('smtp') is not None):
+    with contextlib.suppress(Exception):
+      connection['smtp'].quit()
+
+
+def coalesce_messages(messages):
+  """returns one message with all of the reports in a list of messages, oldest first"""
+
+  if (len(messages) == 1):
+    return messages[0]
+  messages = sorted(messages, key=lambda m: m['time'])
+  body = io.StringIO()
+  for message in messages:
+    print(f"===== {message['subject']} at {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(message['time']))}\n", file=body)
+    print(message['body'], file=body)
+  return {'time': messages[-1]['time'], 'subject': f"{messages[-1]['subject']} ({len(messages)} reports)", 'body': body.getvalue()}
+
+
+def notify_smtp(message, connection):
+  """sends a message to toaddrs, reusing the connection to smtphost of the last one if it is still open"""
+
+  smtpobj = connection.get('smtp')
+  if (smtpobj is not None):
+    try:
+      smtpobj.noop()
+    except (smtplib.SMTPException, OSError):
+      smtpobj = None
+  if (smtpobj is None):
+    connection['smtp'] = None
+    smtpobj = smtplib.SMTP(smtphost, 25, timeout=smtptimeout)
+    connection['smtp'] = smtpobj
+  email = new_report(message['subject'])
+  email.write(message['body'])
+  try:
+    smtpobj.sendmail(sender, toaddrs, email.getvalue())
+  except (smtplib.SMTPServerDisconnected, OSError):
+    connection['smtp'] = None
+    raise
+
+
+def notify_file(message, connection):
+  """appends a message to notifyfile in mbox format"""
+
+  email = new_report(message['subject'])
+  email.write(message['body'])
+  text = email.getvalue().replace("\nFrom ", "\n>From ")
+  with open(notifyfile, "a") as f:
+    fcntl.flock(f, fcntl.LOCK_EX)
+    f.write(f"From vnic-check {time.asctime(time.localtime(message['time']))}\n{text.rstrip()}\n\n")
+
+
+def notify_webhook(message, connection):
+  """posts a message as JSON to notifyurl"""
+
+  url = urlsplit(notifyurl)
+  if (url.scheme == 'https'):
+    conn = http.client.HTTPSConnection(url.netloc, timeout=smtptimeout)
+  else:
+    conn = http.client.HTTPConnection(url.netloc, timeout=smtptimeout)
+  try:
+    conn.request("POST", url.path or "/", json.dumps(message), {'Content-Type': 'application/json'})
+    response = conn.getresponse()
+    response.read()
+    if (response.status // 100 != 2):
+      raise http.client.HTTPException(f"{notifyurl} returned {response.status} {response.reason}")
+  finally:
+    conn.close()
+
+
+notifiers = {'smtp': notify_smtp, 'file': notify_file, 'webhook': notify_webhook} # sink name to the function that sends a message to it
+spoollocks = dict() # spool file to the open file that holds its lock while this run owns it
+spoollock = threading.Lock() # serializes the changes to spoollocks between notify_worker and the main thread
+
+def spool_message(sink, message):
+  """Saves a message for a sink in spooldir and returns its file name, or None if it can not be saved
+
+  The spool file is locked for as long as this run owns it, so another run only takes it over
+  (see spool_orphans) once this one has ended.
+  """
+
+  if (spooldir is None):
+    return None
+  try:
+    os.makedirs(spooldir, exist_ok=True)
+    fd, tmpname = tempfile.mkstemp(dir=spooldir, prefix=sink+"-", suffix=".tmp")
+    f = os.fdopen(fd, "w")
+    fcntl.flock(f, fcntl.LOCK_EX)
+    json.dump(message, f)
+    f.flush()
+    spoolfile = tmpname[:-4]+".msg"
+    os.replace(tmpname, spoolfile)
+  except OSError as e:
+    print(f"WARNING: unable to save the report in {spooldir}: {e}")
+    return None
+  with spoollock:
+    spoollocks[spoolfile] = f
+  return spoolfile
+
+
+def spool_files(mine=False):
+  """returns the names of the spool files, or only the ones this run owns with mine True"""
+
+  if (mine):
+    with spoollock:
+      return [f for f in spoollocks if os.path.exists(f)]
+  if (spooldir is None or not os.path.isdir(spooldir)):
+    return []
+  return [os.path.join(spooldir, f) for f in sorted(os.listdir(spooldir)) if f.endswith(".msg")]
+
+
+def spool_orphans():
+  """returns a list of (sink, spool file, message) for the spool files left by runs that have ended
+
+  Every spool file that is not locked by a running run is taken over by this run.
+  """
+
+  orphans = []
+  for spoolfile in spool_files():
+    try:
+      f = open(spoolfile, "r")
+    except OSError:
+      continue
     try:
-      smtpobj = smtplib.SMTP(smtphost,25)
-      smtpobj.sendmail(sender, toaddrs, email.getvalue())         
-      break
-    except:
-      print(f"Error: unable to send email on try {trynum}, waiting 30 seconds to retry")
-      sleep(30)
-    finally:
-      if smtpobj:
-        smtpobj.quit()
+      fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+      message = json.load(f)
+    except (OSError, ValueError):
+      f.close()
+      continue
+    sink = os.path.basename(spoolfile).split("-")[0]
+    if (sink in notify_sinks()):
+      with spoollock:
+        spoollocks[spoolfile] = f
+      orphans.append((sink, spoolfile, message))
+    else:
+      f.close()
+  return orphans
+
+
+def spool_remove(spoolfile):
+  """removes a spool file once its message has been sent"""
+
+  if (spoolfile is None):
+    return
+  with contextlib.suppress(OSError):
+    os.remove(spoolfile)
+  with spoollock:
+    spoollocks.pop(spoolfile).close()
+
+
+def operating_systems(pool):
+  """returns the operating managed systems on all HMCs
 
-email.close()  
+  The system list of every HMC is requested at the same time on the worker pool, and the
+  result is in HMC and system order.
 
+  Returns a tuple of (systems, notchecked).  systems is a list of (hmc, lssyscfg record) for every
+   operating system, notchecked is a list of (hmc, reason) for the HMCs that could not be asked.
+  """
+
+  def hmc_systems(hmcname):
+    try:
+      return cached_hmc_queries(hmcname,None,[('lssyscfg -r sys',['name','type_model','serial_num','state'],'sys')])[0]
+    except HmcError as e:
+      return e
+
+  systems = []
+  notchecked = []
+  for hmcname, syslist in zip(hmcs, pool.map(hmc_systems, hmcs)):
+    if isinstance(syslist, HmcError):
+      notchecked.append((hmcname, str(syslist)))
+      continue
+    for sys in syslist:
+      if (sys['state'] == "Operating"):
+        systems.append((hmcname, sys))
+  return (systems, notchecked)
+
+
+def start_deadlines():
+  """starts the hmcdeadline time budget of every HMC for one check of all of its systems"""
+
+  for hmcname in hmcs:
+    hmcdeadlines[hmcname] = time.time() + hmcdeadline
+
+
+def run_once():
+  """Checks every vNIC on every system once and prints or emails the report"""
+
+  email = new_report("vNIC Status")
+  sendemail = False
+
+  # Collect the data from all HMCs and systems at the same time.  The results are kept in HMC and
+  # system order so the report is always in the same order.
+  start_deadlines()
+  with concurrent.futures.ThreadPoolExecutor(max_workers=maxworkers) as pool:
+    start = time.time()
+    systems, notchecked = operating_systems(pool)
+    record_phase('systems', time.time() - start)
+    start = time.time()
+    work = [(hmcname, sys, pool.submit(collect_system, hmcname, sys['name'])) for hmcname, sys in systems]
+    concurrent.futures.wait([collected for hmcname, sys, collected in work])
+    record_phase('collect', time.time() - start)
+
+  start = time.time()
+  for hmcname, reason in notchecked:
+    sendemail = True
+    print(f"HMC: {hmcname} not checked - {reason}\n", file=email)
+
+  history = history_open()
+  for hmcname, sys, collected in work:
+    try:
+      vniclist = collected.result()
+    except HmcError as e:
+      sendemail = True
+      print(system_header(sys)+" not checked - "+str(e)+"\n", file=email)
+      record_health(hmcname, sys['name'], None)
+      continue
+
+    findings = check_system(hmcname, sys['name'], vniclist)
+    context = history_record(history, hmcname, sys['name'], vniclist, findings)
+
+    # Generate email contents for errors in this system
+    if (len(findings) > 0):
+      sendemail = True
+      print_findings(sys, findings, email, context, history and history['now'])
+  history_close(history)
+  record_phase('check', time.time() - start)
+
+  start = time.time()
+  send_report(email, sendemail)
+  record_phase('report', time.time() - start)
+  write_metrics(args.metrics_json, args.metrics_prom, 'vnic_check')
+
+
+def analyze_bundle(filename):
+  """Checks every vNIC on every system in an offline bundle from bundle_script
+
+  This is the engine behind --bundle and --archive.  The bundle is read in one pass and each managed
+  system is checked with check_system as soon as all of its sections have been read, so only one
+  system is in memory at a time.  The SRIOV physical port data for the problem descriptions comes
+  from the bundle too, so nothing is asked from an HMC.  The result only has dictionaries, lists and
+  strings, so it can be sent back from an --archive worker process.
+
+  Parameter 1 - the bundle file name, or '-' for stdin
+
+  Returns a dictionary with:
+    file    - the bundle file name
+    hmc     - the HMC host name from the bundle, or the file name if it has none
+    systems - a list with an entry for every operating managed system in the bundle, in bundle order.
+               Each entry is a dictionary with 'system' (the lssyscfg record), 'findings' (from
+               check_system), 'health' (the counts from check_system) and 'notchecked' (the reason
+               it was not checked or None).  findings is empty and health is None if it was not checked.
+    error   - the reason the bundle could not be read, or the end of it could not be read, or None
+  """
+
+  result = {'file': filename, 'hmc': filename, 'systems': [], 'error': None}
+  systems = None # system name to the lssyscfg record of every system in the bundle
+  checked = set()
+
+  try:
+    with open_hmc_output(filename) as f:
+      # the sections of one system follow each other, so they are grouped by system name
+      for sysname, sections in itertools.groupby(read_bundle(f), key=lambda section: section[1]):
+        data = {kind: rows for kind, name, rows in sections}
+        if (sysname is None):
+          if (data.get('hmc')):
+            result['hmc'] = data['hmc'][0]
+          if (data.get('sys') is not None):
+            systems = {sys['name']: sys.asdict() for sys in data['sys']}
+          continue
+
+        sys = (systems or dict()).get(sysname)
+        if (sys is None or sys['state'] != "Operating"):
+          continue
+        checked.add(sysname)
+        entry = {'system': sys, 'findings': dict(), 'health': None, 'notchecked': None}
+        result['systems'].append(entry)
+        if (data.get('vnic') is None):
+          entry['notchecked'] = "the vNIC data in the bundle is missing or failed"
+          continue
+
+        portlookups[(result['hmc'], sysname)] = {p['adapter_id']+"-"+p['phys_port_id']: p
+                                                 for level in ('eth','ethc','roce') for p in (data.get(level) or [])}
+        entry['findings'] = check_system(result['hmc'], sysname, data['vnic'])
+        entry['health'] = dict(metrics['systems'][(result['hmc'], sysname)])
+        del portlookups[(result['hmc'], sysname)]
+  except (OSError, EOFError) as e:
+    # a missing file, or a compressed file that is cut short or damaged
+    result['error'] = str(e)
+
+  if (systems is not None):
+    for sysname, sys in systems.items():
+      if (sys['state'] == "Operating" and sysname not in checked):
+        result['systems'].append({'system': sys, 'findings': dict(), 'health': None, 'notchecked': "it is not in the bundle"})
+  elif (result['error'] is None):
+    result['error'] = "the system list in the bundle is missing or failed"
+  return result
+
+
+def print_bundle(result, email):
+  """adds the problems found in a bundle by analyze_bundle to the report and saves the system health for the metrics
+
+  Returns True if anything was added to the report
+  """
+
+  reported = False
+  for entry in result['systems']:
+    record_health(result['hmc'], entry['system']['name'], entry['health'])
+    if (entry['notchecked'] is not None):
+      reported = True
+      print(system_header(entry['system'])+" not checked - "+entry['notchecked']+"\n", file=email)
+    elif (len(entry['findings']) > 0):
+      reported = True
+      print_findings(entry['system'], entry['findings'], email)
+
+  if (result['error'] is not None):
+    reported = True
+    print(f"HMC: {result['hmc']} bundle {result['file']} not checked completely - {result['error']}\n", file=email)
+  return reported
+
+
+def analyze_archived_bundle(filename):
+  """runs analyze_bundle in an --archive worker process, with the warnings it prints in the result as 'warnings'
+
+  Any exception from analyze_bundle is returned as the 'error' of the result, so one bad bundle does
+  not stop the rest of the archive.
+  """
+
+  out = io.StringIO()
+  with contextlib.redirect_stdout(out):
+    try:
+      result = analyze_bundle(filename)
+    except Exception as e:
+      # a bundle that breaks the checks is reported as not checked instead of ending the whole archive
+      result = {'file': filename, 'hmc': filename, 'systems': [], 'error': f"{type(e).__name__}: {e}"}
+  result['warnings'] = out.getvalue().splitlines()
+  return result
+
+
+def run_bundles(filenames):
+  """Checks every vNIC in the offline bundles and prints or emails the report, like run_once"""
+
+  email = new_report("vNIC Status")
+  sendemail = False
+
+  start = time.time()
+  for filename in filenames:
+    sendemail = print_bundle(analyze_bundle(filename), email) or sendemail
+  record_phase('check', time.time() - start)
+
+  start = time.time()
+  send_report(email, sendemail)
+  record_phase('report', time.time() - start)
+  write_metrics(args.metrics_json, args.metrics_prom, 'vnic_check')
+
+
+def run_archive(directory):
+  """Checks every offline bundle in an archive directory and prints or emails one report for all of them
+
+  Every file in the directory and below it (except hidden files) is read as an offline bundle.
+  Reading and checking a bundle is limited by the CPU, so the bundles are checked by
+  analyze_bundle in a pool of maxprocesses worker processes.  The results are merged in file name
+  order into one report, with the totals for the whole archive and for each check first, then a line
+  for every bundle, then the problems found in each bundle.
+
+  Parameter 1 - the archive directory
+  """
+
+  filenames = []
+  for dirpath, dirnames, names in os.walk(directory):
+    dirnames[:] = [name for name in dirnames if not name.startswith('.')]
+    filenames += [os.path.join(dirpath, name) for name in names if not name.startswith('.')]
+  filenames.sort()
+
+  totals = {'bundles': len(filenames), 'systems': 0, 'notchecked': 0, 'vnics': 0, 'vnicproblems': 0, 'problems': 0}
+  rules = dict.fromkeys(vnicrules, 0)
+  bundlelines = io.StringIO()
+  details = io.StringIO()
+
+  start = time.time()
+  workers = maxprocesses or os.cpu_count() or 1
+  with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+    # a few bundles go to a worker at a time, so a big archive of small bundles is not held up by the hand offs
+    for result in pool.map(analyze_archived_bundle, filenames, chunksize=max(1, len(filenames) // (workers * 8))):
+      counts = {'systems': 0, 'notchecked': 0, 'vnics': 0, 'vnicproblems': 0, 'problems': 0}
+      for entry in result['systems']:
+        if (entry['health'] is None):
+          counts['notchecked'] += 1
+          continue
+        counts['systems'] += 1
+        for name in ('vnics', 'vnicproblems', 'problems'):
+          counts[name] += entry['health'][name]
+        for rule, count in entry['health']['rules'].items():
+          rules[rule] += count
+      for name, count in counts.items():
+        totals[name] += count
+      print(f"{result['file']}  HMC: {result['hmc']}  Systems: {counts['systems']}  Not checked: {counts['notchecked']}  "
+            f"vNICs: {counts['vnics']}  With problems: {counts['vnicproblems']}"+(f"  Error: {result['error']}" if result['error'] is not None else ""),
+            file=bundlelines)
+
+      bundlereport = io.StringIO()
+      for warning in result['warnings']:
+        print(warning, file=bundlereport)
+      if (print_bundle(result, bundlereport) or len(result['warnings']) > 0):
+        print(f"Bundle: {result['file']}  HMC: {result['hmc']}\n", file=details)
+        details.write(bundlereport.getvalue())
+  record_phase('check', time.time() - start)
+
+  start = time.time()
+  email = new_report("vNIC Archive Status")
+  print(f"Archive: {directory}", file=email)
+  print(f"Bundles: {totals['bundles']}  Systems checked: {totals['systems']}  Not checked: {totals['notchecked']}  "
+        f"vNICs: {totals['vnics']}  With problems: {totals['vnicproblems']}  Problems: {totals['problems']}\n", file=email)
+  print("Problems by check:", file=email)
+  for rule in vnicrules:
+    print(f"   {rules[rule]:>8}  {rule}", file=email)
+  print("\nBundles:", file=email)
+  email.write(bundlelines.getvalue())
+  print(file=email)
+  email.write(details.getvalue())
+  send_report(email, True)
+  record_phase('report', time.time() - start)
+  write_metrics(args.metrics_json, args.metrics_prom, 'vnic_check')
+
+
+def run_flapping(count):
+  """Prints the backing devices in the history that changed state more than count times in the last
+  flapwindow seconds, the most changes first
+  """
+
+  history = history_open()
+  if (history is None):
+    print("No history, see historydir at the top of this script")
+    return
+  now = history['now']
+  flapping = []
+  for syskey, system in history['index']['systems'].items():
+    hmc, sysname = syskey.split("\t")
+    for key, (active, status, since, changes) in system['devices'].items():
+      flaps = len(changes) - bisect.bisect_left(changes, now - flapwindow)
+      if (flaps > count):
+        flapping.append((flaps, hmc, sysname, key.split("\t"), status, active, now - since))
+  history_close(history)
+
+  print(f"Backing devices that changed state more than {count} times in the last {duration_text(flapwindow)}:")
+  for flaps, hmc, sysname, (lparid, slot, logport), status, active, age in sorted(flapping, key=lambda f: (-f[0],) + f[1:4]):
+    print(f"  HMC {hmc} system {sysname} LPAR id {lparid} slot {slot} logical port {logport}: "
+          f"{flaps} changes, {status}{' and active' if active == '1' else ''} for {duration_text(age)}")
+  if (len(flapping) == 0):
+    print("  None")
+
+
+def run_daemon():
+  """Keeps checking the vNICs on every system and reports only the changes
+
+  Each system is polled on its own schedule.  A system with problems, or one that just changed, is
+  polled again after pollmin seconds.  Each healthy poll doubles the time until the next one, up to
+  pollmax seconds.  The shared ssh connections and the SRIOV physical port data are kept between
+  polls, and the system list is read again when its cache time to live (cachettl['sys']) is up.
+  A report is only sent when problems appear or clear, or when a system can not be checked in time.
+  """
+
+  known = dict() # (hmc, system name) to the findings of the last poll
+  schedule = dict() # (hmc, system name) to [time of the next poll, current poll interval]
+  systems = dict() # (hmc, system name) to the lssyscfg record
+  unchecked = dict() # (hmc, system name or None for the HMC itself) to the reason the last poll did not complete
+  sysrefresh = 0
+
+  # end cleanly on a kill so the shared ssh connections are closed
+  def stop(signum, frame):
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    exit(0)
+  signal.signal(signal.SIGTERM, stop)
+  notify_start(notifybatch)
+
+  with concurrent.futures.ThreadPoolExecutor(max_workers=maxworkers) as pool:
+    while True:
+      now = time.time()
+      email = new_report("vNIC Status Change")
+      sendemail = False
+
+      start_deadlines()
+
+      if (now >= sysrefresh):
+        syslist, notchecked = operating_systems(pool)
+        record_phase('systems', time.time() - now)
+        # keep polling the systems already known on an HMC that could not be asked this time
+        skipped = [hmcname for hmcname, reason in notchecked]
+        systems = {key: sys for key, sys in systems.items() if key[0] in skipped}
+        systems.update({(hmcname, sys['name']): sys for hmcname, sys in syslist})
+        for hmcname, reason in notchecked:
+          if ((hmcname, None) not in unchecked):
+            sendemail = True
+            print(f"HMC: {hmcname} not checked - {reason}\n", file=email)
+          unchecked[(hmcname, None)] = reason
+        for hmcname in hmcs:
+          if (hmcname not in skipped and unchecked.pop((hmcname, None), None) is not None):
+            sendemail = True
+            print(f"HMC: {hmcname} checked again\n", file=email)
+        for key in list(schedule):
+          if key not in systems:
+            del schedule[key]
+            known.pop(key, None)
+            unchecked.pop(key, None)
+            metrics['systems'].pop(key, None)
+        for key in systems:
+          schedule.setdefault(key, [now, pollmin])
+        portlookups.clear()
+        if (len(notchecked) > 0):
+          sysrefresh = now + pollmin
+        else:
+          sysrefresh = now + cachettl.get('sys', pollmax)
+
+      due = [key for key in systems if schedule[key][0] <= now]
+      start = time.time()
+      work = [(key, pool.submit(collect_system, key[0], key[1])) for key in due]
+      concurrent.futures.wait([collected for key, collected in work])
+      record_phase('collect', time.time() - start)
+
+      start = time.time()
+      history = history_open()
+      for key, collected in work:
+        interval = schedule[key][1]
+
+        # A system that could not be asked keeps its last findings and is tried again soon
+        try:
+          vniclist = collected.result()
+        except HmcError as e:
+          if (key not in unchecked):
+            sendemail = True
+            print(system_header(systems[key])+" not checked - "+str(e)+"\n", file=email)
+          unchecked[key] = str(e)
+          record_health(key[0], key[1], None)
+          schedule[key] = [now + pollmin, pollmin]
+          continue
+        if (unchecked.pop(key, None) is not None):
+          sendemail = True
+          print(system_header(systems[key])+" checked again\n", file=email)
+
+        # An empty vNIC list is most likely a failed query, so it does not clear any problems
+        if (len(vniclist) == 0 and key in known):
+          schedule[key] = [now + interval, interval]
+          continue
+
+        findings = check_system(key[0], key[1], vniclist)
+        context = history_record(history, key[0], key[1], vniclist, findings)
+        lastfindings = known.get(key, dict())
+        known[key] = findings
+
+        syshdr = system_header(systems[key])
+        changed = False
+        for vnicdesc, problems in findings.items():
+          newproblems = [p for p in problems if p not in lastfindings.get(vnicdesc, [])]
+          if (len(newproblems) > 0):
+            changed = True
+            if (syshdr is not None):
+              print(syshdr,file=email)
+              syshdr = None
+            print("New problems with "+vnicdesc, file=email)
+            for problem in newproblems:
+              print("   - "+problem, file=email)
+            for note in context.get(vnicdesc, (None, []))[1]:
+              print("   * "+note, file=email)
+            print(file=email)
+        for vnicdesc, problems in lastfindings.items():
+          cleared = [p for p in problems if p not in findings.get(vnicdesc, [])]
+          if (len(cleared) > 0):
+            changed = True
+            if (syshdr is not None):
+              print(syshdr,file=email)
+              syshdr = None
+            print("Problems cleared on "+vnicdesc, file=email)
+            for problem in cleared:
+              print("   - "+problem, file=email)
+            print(file=email)
+
+        if (changed or len(findings) > 0):
+          interval = pollmin
+        else:
+          interval = min(interval * 2, pollmax)
+        schedule[key] = [now + interval, interval]
+        sendemail = sendemail or changed
+      history_close(history)
+      record_phase('check', time.time() - start)
+
+      start = time.time()
+      if (sendemail):
+        send_report(email, sendemail)
+      else:
+        email.close()
+      record_phase('report', time.time() - start)
+      write_metrics(args.metrics_json, args.metrics_prom, 'vnic_check')
+
+      nextpoll = min([s[0] for s in schedule.values()], default=now + pollmin)
+      sleep(max(nextpoll - time.time(), 1))
+
+#
+## Start of Mainline
+#
 
+# the --archive worker processes can load this script again, so the mainline only runs in the first one
+if __name__ == '__main__':
+  if (args.offline):
+    print(bundle_script())
+  elif (args.archive != None):
+    run_archive(args.archive)
+  elif (args.flapping != None):
+    run_flapping(args.flapping)
+  elif (args.bundle != None):
+    run_bundles(args.bundle)
+  elif (args.daemon):
+    run_daemon()
+  else:
+    run_once()
@@ -9,9 +9,20 @@
 # license: epl-2.0 
 
 import io
-import sys
+import os
+import atexit
+import shlex
 import subprocess
+import threading
+import fnmatch
+import collections
+import concurrent.futures
+import time
 import argparse
+from time import sleep
+import hmclib # the HMC access shared with vnic-check.py, keep hmclib.py in the same directory as this script
+from hmclib import (HmcError, hmc_connect, run_hmc_queries, parse_hmc_lines, open_hmc_output, read_bundle, bundle_script,
+                    backingdevices, backingstates, byprty, record_command, record_phase, write_metrics)
 
 description="""Changes vNIC backing devices to alternate devices to allow maintenance on a VIOS server.
 
@@ -28,6 +39,13 @@ to run on the HMC.  Run that commands and save or cut/paste the output to a text
 where this is run, then re-run this command with the --file option to process the HMC output.  This
 will produce the commmands that should be run to switch the backing devices.  
 
+The --offline output also has one command that collects the vNIC data of every system on the HMC
+(an offline bundle, the same as vnic-check.py --offline).  Save its output, which can be gzip
+compressed, and use it with --bundle for any number of --system names, for example:
+  ssh hscroot@hmc1 "$(vnic-move.py --offline --system x --vios x | tail -1)" | gzip > hmc1.bundle.gz
+  vnic-move.py --bundle hmc1.bundle.gz --system sys1,sys2 --vios vios1
+The bundle is read one line at a time and only the vNIC data of the --system names is kept.
+
 WARNING: in offline mode, be careful that no vNIC changes occur between collection of the --offline
 output and when the output is processed to generate the commands.  It would be wise to run it twice 
 to verify that all changes are complete.
@@ -35,6 +53,34 @@ to verify that all changes are complete.
 The --autofailover option can be used to change the autofailover option on all vNIC devices for 
 the specified system to either 1 or 0.  After VIOS maintenance is complete, it can be used to 
 reset all vNIC devices to the proper backing devices based on priority.
+
+The generated commands are run over one shared ssh connection to the HMC, one at a time on each
+managed system unless --parallel is more than 1.  Commands for the same LPAR are never run at the
+same time.  A summary table with the return code and run time of every command is printed at the
+end.  Use --stop-on-error to skip the remaining commands after the first failure.  A command that runs longer than cmdtimeout seconds is killed
+and reported as failed with return code -1, but it may still complete on the HMC, so check it (or
+use --wait).  Change commands are never retried.  HMC queries are retried up to sshretries times if
+ssh can not connect.
+
+With --wait, the vNIC data for the system is read again every --wait-interval seconds (one HMC
+query per poll for all vNICs) after the commands are run, until every vNIC is active on its new
+backing device (or has the new auto_priority_failover setting) or --wait-timeout seconds have
+passed.  The time each change took is printed, so there is no need to run this twice to check.
+
+With --transport rest the vNIC data is read with the HMC REST API (the password is read from the
+HMC_PASSWORD environment variable or restpasswordfile) over pooled keep-alive connections.  The
+change commands are still run with ssh.
+
+--metrics-json and --metrics-prom write the wall time, output size and failures of every HMC query
+and change command (by system and command type) and the time of each phase of the run, as a JSON
+summary and as a file for the Prometheus node_exporter textfile collector.
+
+--system and --vios both take a list, so a whole group of VIOS can be drained on many systems with
+one run, for example --system sys1,sys2 --vios 'vios*a'.  The vNIC data for every system is read
+once (in one HMC call), then every vNIC that has a backing device on any of the VIOS is planned
+together.  A vNIC whose other backing devices are all on VIOS in the same list is reported as an
+error, and a vNIC that keeps running but has no backup left while the VIOS are down is reported as
+a warning.
 """
 
 parser = argparse.ArgumentParser(description=description)
@@ -42,15 +88,26 @@ parser = argparse.ArgumentParser(description=description)
 inputgroup = parser.add_mutually_exclusive_group(required=True)
 inputgroup.add_argument("--hmc",help="HMC to connect to for vNIC information [username@]hmcname - user portion defaults to hscroot")
 inputgroup.add_argument("--file",help="Filename containing HMC command output (for use wihout connection to HMC)")
+inputgroup.add_argument("--bundle",help="Filename of an offline bundle from the command shown by --offline (can be gzip compressed, - for stdin)")
 inputgroup.add_argument("--offline",help="Show the command to get HMC data for offline use",action="store_true")
 
 reqdgroup = parser.add_mutually_exclusive_group(required=True)
-reqdgroup.add_argument("--vios",help="VIOS to disable backing devices")
+reqdgroup.add_argument("--vios",help="VIOS to disable backing devices - can be repeated or a comma seperated list, and can use shell wildcards like 'vios*a'",action="append")
 reqdgroup.add_argument("--autofailover",help="Set autofailover flag on all vNICs",choices=['0','1'])
 
-parser.add_argument("--system",help="System name for vNICs to process",required=True)
+parser.add_argument("--system",help="System name for vNICs to process - can be repeated or a comma seperated list",action="append",required=True)
 parser.add_argument("--verify",help="Check for errors and print commands but do not run",action="store_true")
 parser.add_argument("--force",help="Run generated commands even if errors are found",action="store_true")
+parser.add_argument("--parallel",help="Number of commands to run at the same time on each managed system (default 1). Commands for the same LPAR always run one at a time",type=int,default=1)
+parser.add_argument("--stop-on-error",help="Do not start any more commands after a command fails",action="store_true")
+parser.add_argument("--wait",help="After running the commands, poll the HMC until every change has taken effect",action="store_true")
+parser.add_argument("--wait-timeout",help="Seconds to wait for the changes to take effect with --wait (default 300)",type=int,default=300)
+parser.add_argument("--wait-interval",help="Seconds between polls of the HMC with --wait (default 5)",type=int,default=5)
+parser.add_argument("--metrics-json",help="Write a JSON summary of the HMC command timings to this file when done")
+parser.add_argument("--metrics-prom",help="Write the HMC command timings to this file for the Prometheus node_exporter textfile collector")
+parser.add_argument("--ssh",help="Command to run instead of ssh, for example 'python3 hmc-sim.py --systems=20' to test without an HMC",default="ssh")
+parser.add_argument("--transport",help="How to read the vNIC data from the HMC: ssh (the HMC command line) or rest (the HMC REST API). The change commands always use ssh",choices=['ssh','rest'],default='ssh')
+parser.add_argument("--rest-url",help="Address of the HMC REST API, {hmc} is replaced by the HMC host name (default https://{hmc}:12443)",default='https://{hmc}:12443')
 
 args = parser.parse_args()
 
@@ -60,33 +117,76 @@ if (args.file!=None and args.hmc!=None):
 if (args.hmc == None):
   if (args.force):
     parser.error("--force is only valid with --hmc")
+  if (args.wait):
+    parser.error("--wait is only valid with --hmc")
 
-if (args.file != None):
-  if (args.file == '-'):
-    hmcORfile=sys.stdin
-  else:
-    hmcORfile=open(args.file,"r")
-else:
-  hmcORfile = args.hmc
-  if hmcORfile != None and not '@' in hmcORfile:
-    hmcORfile = 'hscroot@' + hmcORfile
+if (args.parallel < 1):
+  parser.error("--parallel must be at least 1")
+
+# --file and --bundle are opened with open_hmc_output at the start of the mainline
+hmcORfile = args.hmc
+if hmcORfile != None and not '@' in hmcORfile:
+  hmcORfile = 'hscroot@' + hmcORfile
   
 if (args.offline):
   hmcORfile = "%%OFFLINE"
 
 
-sysname = args.system
-if (sysname == None): 
-  sysname="SYSTEM" 
-  
-viosdown = args.vios # VIOS to be cleared of VNICs
+# --system and --vios can be repeated and can have comma seperated lists
+systems = [name for arg in args.system for name in arg.split(',') if name != '']
+
+drainpatterns = None # VIOS names or wildcard patterns to be cleared of VNICs
+if (args.vios != None):
+  drainpatterns = [name for arg in args.vios for name in arg.split(',') if name != '']
+
+if (args.file != None and len(systems) > 1):
+  parser.error("--file can only be used with one --system")
+
+sshprogram = shlex.split(args.ssh) # the ssh command and any options to start it with
+
+sshpersist='10m' # How long an idle shared ssh connection to the HMC is kept open after the last command
+cmdtimeout = 120 # Seconds before a single HMC command is killed
+sshretries = 2 # Number of times to retry an HMC query when ssh can not connect - change commands are never retried
+sshbackoff = 5 # Seconds to wait before the first retry, doubled for each retry after that
+restpasswordfile = os.path.expanduser('~/.vnic-hmc-password') # REST transport: file with the HMC password (or set HMC_PASSWORD) - make it readable only by you
+restcafile = None # REST transport: file with the CA certificate of the HMC, None to use the system certificates
+restverify = True # REST transport: False to not check the HMC certificate, only for a self-signed HMC certificate you trust
+restworkers = 4 # REST transport: REST requests run at the same time for one managed system
+
+hmclib.setup(sshprogram=sshprogram, transport=args.transport, resturl=args.rest_url, cmdtimeout=cmdtimeout,
+             sshpersist=sshpersist, sshretries=sshretries, sshbackoff=sshbackoff, restpasswordfile=restpasswordfile,
+             restcafile=restcafile, restverify=restverify, restworkers=restworkers)
 
 # Code from here on:
 
-def run_hmc_query(hmc, basecmd, namelist):
+def run_hmc_command(hmc, command):
+  """Runs a command on the HMC over the shared ssh connection
+
+  Parameter 1 - the hmc host name
+  Parameter 2 - the complete command to run on the HMC
+
+  Returns the subprocess.CompletedProcess with the stdout and stderr of the command as strings.  If the
+   command runs longer than cmdtimeout seconds the ssh command is killed and the returncode is -1.
+   If the shared connection could not log in in time the returncode is 255, like any other ssh failure.
+  """
+
+  try:
+    ctlopts = hmc_connect(hmc)
+  except HmcError as e:
+    return subprocess.CompletedProcess(command, 255, '', str(e))
+  sshcmd = sshprogram+[hmc,"-o","BatchMode=yes"]+ctlopts+[command]
+  try:
+    return subprocess.run(sshcmd,stdin=subprocess.DEVNULL,stdout=subprocess.PIPE,stderr=subprocess.PIPE,encoding="utf-8", universal_newlines=True,timeout=cmdtimeout)
+  except subprocess.TimeoutExpired as e:
+    return subprocess.CompletedProcess(sshcmd, -1, e.stdout or '',
+      f"command did not finish within {cmdtimeout} seconds - it may still complete on the HMC")
+
+
+def run_hmc_query(hmc, basecmd, namelist, asdict=False):
   """Runs a query command on HMC and parses output
   
-  Runs a query command on the specified HMC and parses the output into an array of hashes
+  Runs a query command on the specified HMC with hmclib.run_hmc_query, or prints it or reads its
+   output from a file instead, and parses the output into an array of records
    that map field names to field values - one array element per line - like a database
    query function.
 
@@ -96,9 +196,12 @@ def run_hmc_query(hmc, basecmd, namelist):
                      or a file or stream (like sys.stdio) containing the command output 
    2 (required)  :  The base comand to be run.  Usually 'lssyscfg' with some options.
    3 (required)  :  a reference to an Array of field names to retreive.
+   asdict        :  True to return dictionaries instead of the compact row records
 
- Returns a list of disctionaries of field names to field contents.  One element per line returned
-  by the HMC command.
+ Returns a list of records of field names to field contents.  One element per line returned
+  by the HMC command.  The records are read only rows from hmc_row_type that are indexed by
+  field name like a dictionary (row['lpar_id']), or dictionaries if asdict is True.
+  Raises HmcError if the HMC could not be reached or did not answer in time.
 
  Example call:
       alllpars = run_on_hmc(hmc,
@@ -108,7 +211,6 @@ def run_hmc_query(hmc, basecmd, namelist):
 """
 
   command = basecmd + ' --header -F ' + '%'.join(namelist);
-  readdata=''
   
   if (hmc=="%%OFFLINE"):
     print("Collect data from HMC with the following command and store in a file:")
@@ -118,147 +220,356 @@ def run_hmc_query(hmc, basecmd, namelist):
   
   # special case of open file passed for HMC, which allows that file to be substituted for HMC call to allow offline testing
   if (isinstance(hmc,io.IOBase)):
-    readdata = hmc.read()
-  else:
-    process = subprocess.run(["ssh",hmc,"-o","BatchMode=yes",command],stdout=subprocess.PIPE,stderr=subprocess.PIPE,encoding="utf-8", universal_newlines=True) 
-    if (process.returncode != 0):
-      print("Error processing SSH Command: "+command)
-      print(process.stderr)
-      return([])
-    readdata = process.stdout
-    if ("No results were found." in readdata):
-      return([])
-  
-  cmdResp = readdata.split("\n")
-  
-  hdr = cmdResp.pop(0).split('%')
-  
-  rtndata = []
-  
-  for line in cmdResp:
-    mydict = dict()
-    d=line.split("%")
-    if (len(d) == len(hdr)) :
-      for i in range(len(d)):
-        mydict[hdr[i]]=d[i]
-      rtndata.append(mydict)
-    
-  return rtndata
+    return list(parse_hmc_lines(hmc,command,asdict))
 
+  return hmclib.run_hmc_query(hmc, basecmd, namelist, asdict)
 
-def structuredfield(data,namelist):
-  """extract a list of HMC structured fields
-  
-  This function extracts a list of dictionaries from an HMC structured field that contains a comma seperated list of slash delimited values.  WARNING: this
-  will not handle the crazy quoting on fields like virtual_fc_adapters.
-  
-  Parameter 1 - the data to be parsed
-  Paramater 2 - An ordered list of the field names for the slash delimited values for each list item
-  
-  Example Call: backingstate = structuredfield(vnic['backing_device_states'],['sriov','sriov-logical-port-ID','active','status'])
-  
-  Example of  the format processed:
-    sriov/2701c001/1/Operational,sriov/27018001/0/Operational,sriov/27018002/0/NotOperational
-    
-  Example of output from that data:
-    [{'sriov': 'sriov', 'sriov-logical-port-ID': '2701c001', 'active': '1', 'status': 'Operational'}, {'sriov': 'sriov', 'sriov-logical-port-ID': '27018001', 'active': '0', 'status': 'Operational'}, {'sriov': 'sriov', 'sriov-logical-port-ID': '27018002', 'active': '0', 'status': 'NotOperational'}]
-    
+
+CommandResult = collections.namedtuple('CommandResult',['command','returncode','stderr','started','seconds'])
+
+def run_commands(hmc, commands, parallel, stoponerror):
+  """Runs the change commands on the HMC, several at the same time
+
+  The commands are run over the shared ssh connection with up to parallel commands running at the
+  same time on each managed system, using one thread pool per system.  The commands for one LPAR are
+  run one after the other in the order they were generated, so only commands for different LPARs
+  overlap.
+
+  Parameter 1 - the hmc host name
+  Parameter 2 - a list of ((system name, lpar_id), command) tuples
+  Parameter 3 - the maximum number of commands to run at the same time on each managed system
+  Parameter 4 - True to not start any more commands after a command fails
+
+  Returns a list of CommandResult in the same order as the commands.  The returncode is None for
+   commands that were skipped because of an earlier failure.
   """
-  
-  rtndata=[]
-  
-  for group in data.split(','):
-    mydict = dict()
-    d = group.split('/')
-    for i in range(max(len(d),len(namelist))):
-      mydict[namelist[i]]=d[i]
-    rtndata.append(mydict)
-    
-  return rtndata
-  
-  
-def byprty(bdev):
-  """sort function to allow sorting of backing device dictionaries by failover-priority"""
-  
-  return bdev['failover-priority']
 
-#
-## Start of Mainline
-#
+  results = [None for c in commands]
+  failed = threading.Event()
+  printlock = threading.Lock()
+
+  bylpar = dict() # (system name, lpar_id) to the indexes of its commands
+  for i, (lparkey, cmd) in enumerate(commands):
+    bylpar.setdefault(lparkey, []).append(i)
+
+  def run_lpar(indexes):
+    for i in indexes:
+      cmd = commands[i][1]
+      if (stoponerror and failed.is_set()):
+        results[i] = CommandResult(cmd, None, "skipped because an earlier command failed", None, 0.0)
+        continue
+      with printlock:
+        print("running: "+cmd, flush=True)
+      start = time.time()
+      process = run_hmc_command(hmc,cmd)
+      results[i] = CommandResult(cmd, process.returncode, process.stderr.strip(), start, time.time() - start)
+      record_command(hmc, cmd, results[i].seconds, {'bytes': len(process.stdout)}, failed=(process.returncode != 0))
+      if (process.returncode != 0):
+        failed.set()
+        with printlock:
+          print("Error processing SSH Command: "+cmd)
+          print(process.stderr)
+          print(process.stdout, flush=True)
+
+  pools = {sysname: concurrent.futures.ThreadPoolExecutor(max_workers=parallel) for sysname, lparid in bylpar}
+  try:
+    for done in [pools[sysname].submit(run_lpar, indexes) for (sysname, lparid), indexes in bylpar.items()]:
+      done.result()
+  finally:
+    for pool in pools.values():
+      pool.shutdown()
+
+  return results
+
+
+def print_summary(results):
+  """Prints a table of the results from run_commands"""
+
+  print("\nSummary of commands run:")
+  print(f"{'RC':>4} {'Seconds':>8}  Command")
+  for r in results:
+    rc = "-" if r.returncode is None else str(r.returncode)
+    print(f"{rc:>4} {r.seconds:8.2f}  {r.command}")
+    if (r.returncode != 0 and r.stderr != ''):
+      print(f"{'':>15}{r.stderr.splitlines()[0]}")
+
+  failed = len([r for r in results if r.returncode not in (0, None)])
+  skipped = len([r for r in results if r.returncode is None])
+  print(f"{len(results)} commands: {len(results)-failed-skipped} worked, {failed} failed, {skipped} skipped")
+
+def wait_for_changes(hmc, changes, timeout, interval):
+  """Polls the HMC until the vNIC changes have taken effect
+
+  Each poll is a single lshwres query for all of the vNICs on each system that still has changes
+  pending, and all of those queries are sent to the HMC in one call, no matter how many changes
+  are being waited for.  A backing device change is done when the planned logical port is the
+  active one in backing_device_states.  An auto_priority_failover change is done when the vNIC
+  has the new value.
+
+  Parameter 1 - the hmc host name
+  Parameter 2 - a list of (description, system name, lpar_id, slot_num, field, value, started) tuples, where
+                 field is 'logport' or 'auto_priority_failover' and started is when the command was run
+  Parameter 3 - the most seconds to wait
+  Parameter 4 - the seconds between polls
+
+  Returns a dictionary from the change description to the seconds it took to take effect, only
+   for the changes that took effect before the timeout
+  """
 
-errors=0
-commands=[]
+  pending = {(sysname, lparid, slot): (desc, field, value, started) for desc, sysname, lparid, slot, field, value, started in changes}
+  converged = dict()
+  deadline = time.time() + timeout
 
-# these will be parameters
-vniclist = run_hmc_query(hmcORfile,f'lshwres -m {sysname} -r virtualio --rsubtype vnic',['lpar_name','lpar_id','slot_num','auto_priority_failover','backing_devices','backing_device_states'])
+  while len(pending) > 0:
+    # a poll that fails just counts as no progress, the changes are checked again on the next poll
+    try:
+      vnictables = read_vnic_tables(hmc, sorted(set(key[0] for key in pending)))
+    except HmcError as e:
+      print(f"WARNING: unable to poll the HMC: {e}", flush=True)
+      vnictables = dict()
+    now = time.time()
 
-if (hmcORfile=="%%OFFLINE"):
-  exit(0)
+    for sysname, vniclist in vnictables.items():
+      for vnic in vniclist:
+        key = (sysname, vnic['lpar_id'], vnic['slot_num'])
+        if key not in pending:
+          continue
+        desc, field, value, started = pending[key]
+        if (field == 'logport'):
+          done = any(bstate['sriov-logical-port-ID'] == value and bstate['active'] == '1' for bstate in backingstates(vnic['backing_device_states']))
+        else:
+          done = (vnic[field] == value)
+        if (done):
+          converged[desc] = now - started
+          print(f"{desc} done after {now - started:.1f} seconds", flush=True)
+          del pending[key]
+
+    if (len(pending) == 0 or now >= deadline):
+      break
+    sleep(min(interval, deadline - now))
+
+  return converged
+
+
+vnicfields = ['lpar_name','lpar_id','slot_num','auto_priority_failover','backing_devices','backing_device_states']
 
+def vnic_command(sysname):
+  """returns the HMC command that lists the vNICs of a managed system"""
 
-viosfound=False
+  return f'lshwres -m {sysname} -r virtualio --rsubtype vnic'
 
-for vnic in vniclist:
-  if (viosdown != None):
-    # this part is for vios disable processing 
-    changeit = False
+
+def read_vnic_tables(hmcORfile, systems):
+  """Reads the vNIC data of every system once
+
+  From an HMC, the queries for all of the systems are sent in one call with run_hmc_queries.  An
+  offline file only holds the output for one system.  An offline bundle (--bundle) is read in one
+  pass, keeping only the vNIC sections of the systems.
+
+  Parameter 1 - the hmc host name, '%%OFFLINE' or an open file (see run_hmc_query)
+  Parameter 2 - the list of managed system names
+
+  Returns a dictionary from system name to its vniclist, in the order of the systems.  Raises
+   HmcError if a system is missing from the bundle.
+  """
+
+  if (args.bundle != None):
+    vnictables = {sysname: None for sysname in systems}
+    for kind, sysname, rows in read_bundle(hmcORfile, lambda kind, name: kind == 'vnic' and name in vnictables):
+      if (rows is None):
+        raise HmcError(f"the vNIC data for {sysname} in the bundle is missing or failed")
+      vnictables[sysname] = rows
+    for sysname, rows in vnictables.items():
+      if (rows is None):
+        raise HmcError(f"system {sysname} is not in the bundle")
+    return vnictables
+
+  if (isinstance(hmcORfile,io.IOBase) or hmcORfile == "%%OFFLINE"):
+    return {sysname: run_hmc_query(hmcORfile,vnic_command(sysname),vnicfields) for sysname in systems}
+
+  return dict(zip(systems, run_hmc_queries(hmcORfile,[(vnic_command(sysname),vnicfields) for sysname in systems])))
+
+
+def index_vnics(vnictables):
+  """Builds the indexes used to plan changes from the vNIC data of all systems
+
+  Every backing device of every vNIC is decoded once, so the time to build the indexes and to plan
+  from them grows linearly with the number of backing devices.
+
+  Parameter 1 - the dictionary from system name to vniclist from read_vnic_tables
+
+  Returns a tuple of (vnics, byvios):
+    vnics     - a list of (system name, vnic, devices) in system and vNIC order, where devices is the
+                 list of (bdev, bstate) for the vNIC sorted by failover priority
+    byvios    - (system name, VIOS name) to the list of (vnic, bdev, bstate) of its backing devices
+  """
+
+  vnics = []
+  byvios = dict()
+
+  for sysname, vniclist in vnictables.items():
+    for vnic in vniclist:
+      statlookup = {bstate['sriov-logical-port-ID']: bstate for bstate in backingstates(vnic['backing_device_states'])}
+
+      devices = []
+      for bdev in sorted(backingdevices(vnic['backing_devices']),key=byprty):
+        bstate = statlookup[bdev['sriov-logical-port-ID']]
+        byvios.setdefault((sysname, bdev['vios-lpar-name']), []).append((vnic, bdev, bstate))
+        devices.append((bdev, bstate))
+      vnics.append((sysname, vnic, devices))
+
+  return (vnics, byvios)
+
+
+def plan_evacuation(vnics, drainset):
+  """Plans the commands to move every vNIC off the VIOS being drained
+
+  Every vNIC with a backing device on a VIOS being drained is checked.  A vNIC that is active on
+  one of them is moved to its lowest (number) priority backing device that is operational and not
+  on a VIOS being drained.  It is an error if there is no such device, which includes the case where
+  all of its other backing devices are on VIOS that are also being drained.  A vNIC that stays where
+  it is but loses every backup device while the VIOS are down gets a warning.
+
+  Parameter 1 - the vnics list from index_vnics
+  Parameter 2 - the set of (system name, VIOS name) being drained
+
+  Returns a tuple of (commands, changes, errors, warnings), where commands is a list of
+   ((system name, lpar_id), command) and changes is the matching list of
+   (description, system name, lpar_id, slot_num, field, value) for --wait
+  """
+
+  commands = []
+  changes = []
+  errors = 0
+  warnings = 0
+
+  for sysname, vnic, devices in vnics:
+    drained = [bdev for bdev, bstate in devices if (sysname, bdev['vios-lpar-name']) in drainset]
+    if (len(drained) == 0):
+      continue
+
+    vnicdesc = "Lpar "+vnic['lpar_name']+" slot "+vnic['slot_num']+" on "+sysname
+    origbdev = None
     newbdev = None
-    backinglist = structuredfield(vnic['backing_devices'],['sriov','vios-lpar-name','vios-lpar-ID','sriov-adapter-ID','sriov-physical-port-ID','sriov-logical-port-ID',
-    'current-capacity','desired-capacity','failover-priority','current-max-capacity','desired-max-capacity'])
-    backingstate = structuredfield(vnic['backing_device_states'],['sriov','sriov-logical-port-ID','active','status'])
-  
-    # make a lookup table by sriov-logical-port-id
-    statlookup = dict()
-    for bstate in backingstate:
-      statlookup[bstate['sriov-logical-port-ID']]=bstate
-  
-    for bdev in sorted(backinglist,key=byprty):
-      bstate = statlookup[bdev['sriov-logical-port-ID']]
-      bdev['state']=bstate
-      if (bdev['vios-lpar-name'] == viosdown):
-        viosfound=True
-        if (bstate['active']=='1'):
-          changeit = True
-      else:
-        if (bstate['status'] == 'Operational'):
-          if (newbdev == None):
-            # only the first one
-            newbdev = bdev
+    for bdev, bstate in devices:
       if (bstate['active']=='1'):
         origbdev = bdev
-    
-    if (changeit):
+      elif (newbdev is None and bstate['status'] == 'Operational' and (sysname, bdev['vios-lpar-name']) not in drainset):
+        # only the first one
+        newbdev = bdev
+    drainnames = ", ".join(sorted(set(bdev['vios-lpar-name'] for bdev in drained)))
+
+    if (origbdev is None):
+      print("NOT Changing "+vnicdesc+" because it has no active backing device")
+    elif (any(origbdev is bdev for bdev in drained)):
       if (newbdev == None):
-        print("ERROR: No operational backup device found to replace active device on "+viosdown+" for Lpar "+vnic['lpar_id']+" slot "+vnic['slot_num'])
+        others = [bdev for bdev, bstate in devices if (sysname, bdev['vios-lpar-name']) not in drainset]
+        if (len(others) == 0):
+          print("ERROR: every backing device for Lpar "+vnic['lpar_id']+" slot "+vnic['slot_num']+" on "+sysname+" is on a VIOS being drained ("+drainnames+")")
+        else:
+          print("ERROR: No operational backup device found to replace active device on "+origbdev['vios-lpar-name']+" for Lpar "+vnic['lpar_id']+" slot "+vnic['slot_num']+" on "+sysname)
         errors+=1
       else:
         cmd = "chhwres -m "+sysname+" -r virtualio --rsubtype vnicbkdev -o act --id "+vnic['lpar_id']+" -s "+vnic['slot_num']+" --logport "+newbdev['sriov-logical-port-ID']
-        commands.append(cmd)
-        print("Changing Lpar "+vnic['lpar_name']+" slot "+vnic['slot_num']+" to device with priority "+newbdev['failover-priority']+" because it IS running on vios "+viosdown)
+        commands.append(((sysname, vnic['lpar_id']),cmd))
+        changes.append((vnicdesc+" active on logical port "+newbdev['sriov-logical-port-ID'],sysname,vnic['lpar_id'],vnic['slot_num'],'logport',newbdev['sriov-logical-port-ID']))
+        print("Changing "+vnicdesc+" to device with priority "+newbdev['failover-priority']+" on vios "+newbdev['vios-lpar-name']+" because it IS running on vios "+origbdev['vios-lpar-name'])
     else:
-      print("NOT Changing Lpar "+vnic['lpar_name']+" slot "+vnic['slot_num']+" because it is running on vios "+origbdev['vios-lpar-name'])
+      print("NOT Changing "+vnicdesc+" because it is running on vios "+origbdev['vios-lpar-name'])
+      if (newbdev is None):
+        print("WARNING: "+vnicdesc+" will have no operational backup device while "+drainnames+" is down")
+        warnings+=1
+
+  return (commands, changes, errors, warnings)
+
+
+def plan_autofailover(vnics, value):
+  """Plans the commands to set auto_priority_failover on every vNIC that does not have the value
+
+  Parameter 1 - the vnics list from index_vnics
+  Parameter 2 - the new auto_priority_failover value, '0' or '1'
+
+  Returns a tuple of (commands, changes) in the same format as plan_evacuation
+  """
+
+  commands = []
+  changes = []
 
-  elif (args.autofailover != None):
-    # this part is for autofailover processing
-    viosfound = True # This just keeps the vios not found from triggering
-    if (args.autofailover != vnic['auto_priority_failover']):
-      cmd = "chhwres -m "+sysname+" -r virtualio --rsubtype vnic -o s --id "+vnic['lpar_id']+" -s "+vnic['slot_num']+" -a \"auto_priority_failover="+str(args.autofailover)+'"'
-      commands.append(cmd)
-      print("Changing Lpar "+vnic['lpar_name']+" slot "+vnic['slot_num']+" to auto_priority_failover="+str(args.autofailover))
+  for sysname, vnic, devices in vnics:
+    if (value != vnic['auto_priority_failover']):
+      cmd = "chhwres -m "+sysname+" -r virtualio --rsubtype vnic -o s --id "+vnic['lpar_id']+" -s "+vnic['slot_num']+" -a \"auto_priority_failover="+value+'"'
+      commands.append(((sysname, vnic['lpar_id']),cmd))
+      changes.append(("Lpar "+vnic['lpar_name']+" slot "+vnic['slot_num']+" on "+sysname+" auto_priority_failover="+value,
+                      sysname,vnic['lpar_id'],vnic['slot_num'],'auto_priority_failover',value))
+      print("Changing Lpar "+vnic['lpar_name']+" slot "+vnic['slot_num']+" on "+sysname+" to auto_priority_failover="+value)
 
-if (not viosfound):
-  print("ERROR: vios "+viosdown+" was not found in any vNIC record - verify parameters are correct, especially vios name")
-  errors+=1
+  return (commands, changes)
+
+#
+## Start of Mainline
+#
+
+errors=0
+
+if (args.file != None or args.bundle != None):
+  try:
+    hmcORfile=open_hmc_output(args.file if args.file != None else args.bundle)
+  except OSError as e:
+    parser.error(str(e))
+
+# the metrics are written however the script ends
+atexit.register(write_metrics, args.metrics_json, args.metrics_prom, 'vnic_move')
+
+start = time.time()
+try:
+  vnictables = read_vnic_tables(hmcORfile, systems)
+  record_phase('read', time.time() - start)
+except HmcError as e:
+  print(f"ERROR: {e}")
+  exit(1)
+
+if (hmcORfile=="%%OFFLINE"):
+  print("\nOr collect the data of every system on the HMC with the following command and use the output with --bundle:")
+  print(bundle_script())
+  exit(0)
 
-if (args.file != None or args.verify):
+start = time.time()
+vnics, byvios = index_vnics(vnictables)
+
+if (drainpatterns != None):
+  # this part is for vios disable processing
+  drainset = set()
+  for pattern in drainpatterns:
+    matched = [key for key in byvios if fnmatch.fnmatchcase(key[1], pattern)]
+    if (len(matched) == 0):
+      print("ERROR: vios "+pattern+" was not found in any vNIC record - verify parameters are correct, especially vios name")
+      errors+=1
+    drainset.update(matched)
+
+  for sysname, viosname in sorted(drainset):
+    devices = byvios[(sysname, viosname)]
+    active = len([d for d in devices if d[2]['active'] == '1'])
+    print(f"Draining vios {viosname} on {sysname}: {len(devices)} backing devices, {active} active")
+
+  commands, changes, planerrors, warnings = plan_evacuation(vnics, drainset)
+  errors += planerrors
+  if (warnings>0):
+    print("WARNING: "+str(warnings)+" vNICs will have no backup device during the maintenance")
+
+elif (args.autofailover != None):
+  # this part is for autofailover processing
+  commands, changes = plan_autofailover(vnics, str(args.autofailover))
+record_phase('plan', time.time() - start)
+
+if (args.file != None or args.bundle != None or args.verify):
   print("\nCommands to change vNIC Backing devices are:")
-  for cmd in commands:
+  for lparkey, cmd in commands:
     print(cmd)
   
 if (errors>0):
   print("ERROR: "+str(errors)+" errors found")
   
-if (args.verify or args.file != None):
+if (args.verify or args.file != None or args.bundle != None):
   exit(0)
 
 if (errors>0):
@@ -271,10 +582,20 @@ if (errors>0):
 
 print("Running commands to change vNIC")
 
-for cmd in commands:
-  print("running: "+cmd)
-  process = subprocess.run(["ssh",hmcORfile,"-o","BatchMode=yes",cmd],stdout=subprocess.PIPE,stderr=subprocess.PIPE,encoding="utf-8", universal_newlines=True) 
-  if (process.returncode != 0):
-    print("Error processing SSH Command: "+cmd)
-    print(process.stderr)
-    print(process.stdout)
+start = time.time()
+results = run_commands(hmcORfile, commands, args.parallel, args.stop_on_error)
+record_phase('run', time.time() - start)
+print_summary(results)
+
+if (args.wait):
+  # only wait for the changes whose commands worked
+  waitfor = [change + (r.started,) for change, r in zip(changes, results) if r.returncode == 0]
+  print(f"\nWaiting up to {args.wait_timeout} seconds for {len(waitfor)} changes to take effect")
+  start = time.time()
+  converged = wait_for_changes(hmcORfile, waitfor, args.wait_timeout, args.wait_interval)
+  record_phase('wait', time.time() - start)
+  notdone = [change[0] for change in waitfor if change[0] not in converged]
+  for desc in notdone:
+    print("NOT done after "+str(args.wait_timeout)+" seconds: "+desc)
+  if (len(notdone) == 0):
+    print(f"All {len(waitfor)} changes are done")